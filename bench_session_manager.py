@@ -0,0 +1,92 @@
+"""GlobalSessionManager.get_or_create_session 并发吞吐微基准
+
+模拟一批用户同时连接：大量协程并发查找/创建会话，其中一部分会话正持有自身锁做耗时操作（如连接MCP）。
+对比旧实现（单个manager_lock，并在锁内等待session.activate）与分片实现。
+
+用法: python bench_session_manager.py [--sessions 2000] [--calls 20000] [--busy 20] [--busy-hold 0.05]
+"""
+import argparse
+import asyncio
+import time
+
+from session import GlobalSessionManager, Session
+
+class SingleLockSessionManager(GlobalSessionManager):
+    """分片前的实现：所有查找/创建都串行在一把全局锁上"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manager_lock = asyncio.Lock()
+        self.sessions = {}
+
+    async def get_or_create_session(self, session_id, create=True, session_main=None) -> Session:
+        async with self.manager_lock:
+            if session_id not in self.sessions:
+                if create:
+                    self.sessions[session_id] = Session(session_id, self.sandbox_service, expires=self.expires, expiry_scheduler=self.expiry_scheduler)
+                    asyncio.create_task(session_main(self.sessions[session_id]))
+            session = self.sessions.get(session_id, None)
+            if session is not None:
+                await session.activate()
+            return session
+
+async def idle_runner(sess: Session):
+    while True:
+        request, _ = await sess.get_request()
+        if request is None:
+            return
+
+async def hold_lock(sess: Session, seconds: float, until: float):
+    # 反复持有会话锁，模拟register_stateful_mcp等持锁的耗时操作
+    while time.perf_counter() < until:
+        async with sess.lock:
+            await asyncio.sleep(seconds)
+        await asyncio.sleep(0)
+
+async def run(manager: GlobalSessionManager, args) -> tuple[float, float]:
+    # 阶段1: 突发创建
+    start = time.perf_counter()
+    await asyncio.gather(*(manager.get_or_create_session(f"s{i}", session_main=idle_runner) for i in range(args.sessions)))
+    create_elapsed = time.perf_counter() - start
+
+    # 阶段2: 部分会话持锁时并发查找已存在的会话，其中1%的请求落在持锁的会话上
+    busy = [await manager.get_or_create_session(f"s{i}", create=False) for i in range(args.busy)]
+    until = time.perf_counter() + 3600
+    holders = [asyncio.create_task(hold_lock(sess, args.busy_hold, until)) for sess in busy]
+    await asyncio.sleep(0)
+
+    sem = asyncio.Semaphore(args.concurrency)
+    async def lookup(i):
+        async with sem:
+            session_id = f"s{i // 100 % args.busy}" if i % 100 == 0 else f"s{args.busy + i % (args.sessions - args.busy)}"
+            await manager.get_or_create_session(session_id, session_main=idle_runner)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(lookup(i) for i in range(args.calls)))
+    lookup_elapsed = time.perf_counter() - start
+    for task in holders:
+        task.cancel()
+    await asyncio.gather(*holders, return_exceptions=True)
+    return args.sessions / create_elapsed, args.calls / lookup_elapsed
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--busy", type=int, default=20)
+    parser.add_argument("--busy-hold", type=float, default=0.05)
+    parser.add_argument("--shards", type=int, default=16)
+    args = parser.parse_args()
+
+    managers = [
+        ("single lock", SingleLockSessionManager(enable_sandbox=False, expires=3600)),
+        (f"{args.shards} shards", GlobalSessionManager(enable_sandbox=False, expires=3600, num_shards=args.shards)),
+    ]
+    print(f"sessions={args.sessions} calls={args.calls} concurrency={args.concurrency} busy={args.busy} hold={args.busy_hold}s")
+    print(f"{'manager':<14} | {'create/s':>12} | {'lookup/s':>12}")
+    for name, manager in managers:
+        create_tps, lookup_tps = await run(manager, args)
+        print(f"{name:<14} | {create_tps:>12.0f} | {lookup_tps:>12.0f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""VLTokenCounter 分词后端基准：速度与相对本地 tokenizer.json 的误差
+
+样本取自仓库内的中文文档、Python 源码、JSON 以及 agentscope 的英文 docstring，
+分别用字符数估算和本地分词器计数，并模拟多轮推理中每一步的压缩检查开销。
+
+用法: python bench_tokenizer.py [--tokenizer .agent/tokenizer.json] [--steps 200]
+"""
+import argparse
+import asyncio
+import glob
+import inspect
+import json
+import re
+import time
+
+import agentscope.agent
+
+from conf import TOKENIZER_FILE
+from model import FormattedMessages, IncrementalTokenCounter, TextTokenizer, TokenizerFile, VLTokenCounter
+
+CJK = re.compile(r"[一-鿿]")
+
+def load_samples() -> dict[str, list[str]]:
+    readme = open("README.md", encoding="utf-8").read().split("\n\n")
+    code = [open(p, encoding="utf-8").read() for p in sorted(glob.glob("*.py"))]
+    english = [inspect.getdoc(obj) for _, obj in inspect.getmembers(agentscope.agent, inspect.isclass) for obj in [obj, *vars(obj).values()] if inspect.getdoc(obj)]
+    records = [json.dumps({"id": i, "title": f"结果 {i}", "url": f"https://example.com/{i}", "snippet": p[:200]}, ensure_ascii=False) for i, p in enumerate(readme)]
+    return {
+        "zh": [p for p in readme if len(CJK.findall(p)) > len(p) / 4],
+        "en": list(dict.fromkeys(english)),
+        "code": code,
+        "json": records,
+    }
+
+def bench_backend(tokenizer: TextTokenizer, texts: list[str], repeat: int) -> tuple[int, float]:
+    tokenizer.count_batch(texts) # 预热
+    start = time.perf_counter()
+    for _ in range(repeat):
+        total = sum(tokenizer.count_batch(texts))
+    return total, (time.perf_counter() - start) / repeat
+
+async def bench_steps(tokenizer: TextTokenizer, samples: dict[str, list[str]], steps: int) -> tuple[float, float]:
+    # 模拟推理循环：每步追加一条工具结果，压缩检查统计整段历史
+    pool = [text for texts in samples.values() for text in texts]
+    history = FormattedMessages([{"role": "system", "content": [{"type": "text", "text": pool[0]}]}]) # 与ReasoningHintFormatter的输出一样带来源Msg id
+    history.sources.append(("system", 0))
+    full, incremental = VLTokenCounter(tokenizer=tokenizer), IncrementalTokenCounter(VLTokenCounter(tokenizer=tokenizer))
+    full_elapsed = incremental_elapsed = 0.0
+    for step in range(steps):
+        history.append({"role": "tool", "tool_call_id": str(step), "content": [{"type": "text", "text": pool[step % len(pool)]}]})
+        history.sources.append((str(step), 0))
+        start = time.perf_counter()
+        n_full = await full.count(history)
+        full_elapsed += time.perf_counter() - start
+        start = time.perf_counter()
+        n_incremental = await incremental.count(history)
+        incremental_elapsed += time.perf_counter() - start
+        assert n_full == n_incremental
+    return full_elapsed / steps, incremental_elapsed / steps
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default=TOKENIZER_FILE)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=200)
+    args = parser.parse_args()
+
+    samples = load_samples()
+    backends = [("heuristic", TextTokenizer())]
+    try:
+        backends.append(("tokenizer.json", TokenizerFile(args.tokenizer)))
+    except Exception as e:
+        print(f"tokenizer {args.tokenizer} unavailable ({e}), only the heuristic is measured")
+
+    print(f"{'sample':<8} | {'chars':>9} | {'backend':<14} | {'tokens':>9} | {'error':>8} | {'ms/batch':>9} | {'chars/s':>12}")
+    for name, texts in samples.items():
+        chars = sum(len(text) for text in texts)
+        reference = None
+        for backend, tokenizer in reversed(backends): # 以本地分词器为基准，没有时不计算误差
+            total, elapsed = bench_backend(tokenizer, texts, args.repeat)
+            if backend == "tokenizer.json":
+                reference = total
+            error = f"{(total - reference) / reference:+.1%}" if reference else "-"
+            print(f"{name:<8} | {chars:>9} | {backend:<14} | {total:>9} | {error:>8} | {elapsed * 1000:>9.2f} | {chars / elapsed:>12.0f}")
+
+    print(f"\nper-step compression check over {args.steps} steps")
+    print(f"{'backend':<14} | {'full ms':>9} | {'incremental ms':>14}")
+    for backend, tokenizer in backends:
+        full, incremental = await bench_steps(tokenizer, samples, args.steps)
+        print(f"{backend:<14} | {full * 1000:>9.3f} | {incremental * 1000:>14.3f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import uuid
+from collections import OrderedDict
+from typing import List
+
+BLOB_URL_PREFIX = "/blob/"
+BLOB_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+BLOB_UNAVAILABLE_TEXT = "[image unavailable]"
+
+def sniff_media_type(data: bytes) -> str:
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "application/octet-stream"
+
+class BlobStore:
+    """按内容寻址的图片存储，文件名是内容的sha256
+
+    消息里只保存 `/blob/<hash>` 形式的URL引用，会话文件和/history不再携带base64；
+    格式化给模型时才解析为data URL，最近用过的data URL按总字节数做LRU缓存。
+    """
+    def __init__(self, root: str = ".blobs", cache_bytes: int = 64 * 1024 * 1024):
+        self.root = root
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.data_urls: OrderedDict[str, str] = OrderedDict() # hash -> data URL
+
+    def path(self, blob_hash: str) -> str:
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def put(self, data: bytes) -> str:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+        if not os.path.exists(path): # 内容相同的图片只存一份
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return blob_hash
+
+    def exists(self, blob_hash: str) -> bool:
+        return bool(BLOB_HASH_RE.match(blob_hash)) and os.path.exists(self.path(blob_hash))
+
+    def url(self, blob_hash: str) -> str:
+        return f"{BLOB_URL_PREFIX}{blob_hash}"
+
+    def get(self, blob_hash: str) -> bytes | None:
+        if not BLOB_HASH_RE.match(blob_hash):
+            return None
+        try:
+            with open(self.path(blob_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def blob_hash(url: str) -> str | None:
+        """`/blob/<hash>` 引用返回hash，其他URL返回None"""
+        if isinstance(url, str) and url.startswith(BLOB_URL_PREFIX):
+            blob_hash = url[len(BLOB_URL_PREFIX):]
+            if BLOB_HASH_RE.match(blob_hash):
+                return blob_hash
+        return None
+
+    def data_url(self, blob_hash: str) -> str | None:
+        data_url = self.data_urls.get(blob_hash)
+        if data_url is not None:
+            self.data_urls.move_to_end(blob_hash)
+            return data_url
+        data = self.get(blob_hash)
+        if data is None:
+            return None
+        data_url = f"data:{sniff_media_type(data)};base64,{base64.b64encode(data).decode()}"
+        self.data_urls[blob_hash] = data_url
+        self.cached_bytes += len(data_url)
+        while self.cached_bytes > self.cache_bytes and len(self.data_urls) > 1:
+            _, evicted = self.data_urls.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+        return data_url
+
+    def resolve_block(self, block: dict) -> dict:
+        """把 `/blob/<hash>` 图片引用还原为base64 ImageBlock；引用的文件已不存在时换成文本占位，其他图片原样返回"""
+        source = block.get("source") or {}
+        blob_hash = self.blob_hash(source.get("url")) if source.get("type") == "url" else None
+        if blob_hash is None:
+            return block
+        data_url = self.data_url(blob_hash)
+        if data_url is None: # 原样交给formatter会因无效URL报错，会话之后的每次请求都会失败
+            return {"type": "text", "text": BLOB_UNAVAILABLE_TEXT}
+        media_type, data = data_url[len("data:"):].split(";base64,", 1)
+        return {**block, "source": {"type": "base64", "media_type": media_type, "data": data}}
+
+    async def externalize(self, content: List[dict]) -> List[dict]:
+        """把content里的base64图片写入blob存储，替换为 `/blob/<hash>` 引用"""
+        async def store(block: dict) -> dict:
+            source = block.get("source") or {}
+            if block.get("type") != "image" or source.get("type") != "base64":
+                return block
+            blob_hash = await asyncio.to_thread(self.put, base64.b64decode(source["data"]))
+            return {**block, "source": {"type": "url", "url": self.url(blob_hash)}}
+        return list(await asyncio.gather(*(store(block) for block in content)))
+
+    async def externalize_tool_results(self, msg) -> bool:
+        """把消息里tool_result输出中的base64图片（如浏览器截图）原地替换为blob引用，返回是否有修改"""
+        if isinstance(msg.content, str):
+            return False
+        content = []
+        for block in msg.content:
+            output = block.get("output") if block.get("type") == "tool_result" else None
+            if isinstance(output, list):
+                externalized = await self.externalize(output)
+                if any(a is not b for a, b in zip(externalized, output)):
+                    block = {**block, "output": externalized}
+            content.append(block)
+        changed = any(a is not b for a, b in zip(content, msg.content))
+        if changed:
+            msg.content = content
+        return changed
+
+BLOB_STORE = BlobStore()
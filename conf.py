@@ -13,5 +13,39 @@ FLAGS = {
     "enable_reme":                  False,   # 是否启用ReMe
 }
 
+# LLM HTTP连接池（所有OpenAIChatModel共享）
+LLM_HTTP_POOL = {
+    "http2":                        True,   # 安装h2时启用HTTP/2
+    "max_connections":              200,    # 最大连接数
+    "max_keepalive_connections":    50,     # 最大空闲keep-alive连接数
+    "keepalive_expiry":             120,    # 空闲连接保持时间（秒）
+    "timeout":                      600,    # 请求超时（秒）
+    "connect_timeout":              5,      # 建连超时（秒）
+}
+
+# 会话表：数量上限和进程RSS预算，超出时按LRU淘汰空闲会话；0表示不限制
+SESSION_LIMITS = {
+    "expires":                      300,    # 会话空闲过期时间（秒）
+    "max_sessions":                 1000,   # 会话数上限
+    "max_rss_mb":                   4096,   # 进程RSS预算（MB）
+}
+
+# 本地分词器文件（HuggingFace tokenizer.json），用于上下文压缩的token计数；不存在时按字符数估算
+TOKENIZER_FILE = ".agent/tokenizer.json"
+
+# /chat图片预处理：超过像素预算时等比缩小，重新压缩并去掉EXIF等元数据
+IMAGE_PREPROCESS = {
+    "enable":                       True,
+    "max_pixels":                   1280*28*28,  # 与通义千问VL默认的max_pixels一致，超出部分模型侧也会缩小
+    "format":                       "WEBP",      # WEBP / JPEG / PNG
+    "quality":                      85,
+    "max_upload_mb":                20,          # /upload_image单张图片大小上限
+}
+
+# /chat SSE下发：同一消息的连续chunk在队列中合并，flush窗口内的事件一次写出
+SSE_STREAM = {
+    "flush_ms":                     30,     # 拿到事件后再等待的时间（毫秒），0表示逐条下发
+}
+
 # 需要人工确认的工具列表（ToolGuardMixin 使用）
 GUARD_TOOLS = ['write_text_file','insert_text_file','execute_shell_command']
\ No newline at end of file
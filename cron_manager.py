@@ -52,6 +52,12 @@ class CronManager:
         self._jobs: Dict[str, CronJob] = {}
         self._lock = asyncio.Lock()
         self._persistence_path = persistence_path
+        self._instance = uuid.uuid4().hex # 进程重启后版本号从头计数，加上实例标识避免与重启前的版本混淆
+        self._mutations = 0
+    
+    def version(self) -> tuple:
+        """任务列表的版本标识，增删任务或任务协程结束时变化"""
+        return (self._instance, self._mutations, tuple(job.task is not None and not job.task.done() for job in self._jobs.values()))
     
     async def load_from_disk(self):
         if not os.path.exists(self._persistence_path):
@@ -63,6 +69,7 @@ class CronManager:
                 job = CronJob.from_dict(job_data)
                 async with self._lock:
                     self._jobs[job.id] = job
+                    self._mutations += 1
                 next_delay = self._get_next_delay(job.cron_expr)
                 job.task = asyncio.create_task(self._run_cron_job(job, next_delay))
             print(f"[CronManager] Loaded {len(self._jobs)} jobs from {self._persistence_path}")
@@ -114,6 +121,7 @@ class CronManager:
         job = CronJob(job_id, cron_expr, task_description)
         async with self._lock:
             self._jobs[job.id] = job
+            self._mutations += 1
         next_delay = self._get_next_delay(cron_expr)
         job.task = asyncio.create_task(self._run_cron_job(job, next_delay))
         await self._save_to_disk()
@@ -128,6 +136,7 @@ class CronManager:
             if job.task and not job.task.done():
                 job.task.cancel()
             del self._jobs[job_id]
+            self._mutations += 1
         await self._save_to_disk()
         return True
     
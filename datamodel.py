@@ -1,22 +1,24 @@
-import asyncio
 import uuid
 from typing import List
 from pydantic import BaseModel
 from agentscope.message import ImageBlock, TextBlock ,ToolUseBlock
-from agentscope.memory import MemoryBase
+from stream import ResponseQueue
 
 class ChatRequest(BaseModel):
     session_id: str
     content: List[TextBlock|ImageBlock]
+    images: List[str] = [] # /upload_image返回的图片id，按顺序追加在content之后
     deepresearch: bool = False
+    delta: bool = False # SSE增量模式：只下发相对上一个chunk追加的内容
 
 class AgentRequest:
-    def __init__(self, session_id: str, content: List[TextBlock|ImageBlock], deepresearch: bool = False) :
+    def __init__(self, session_id: str, content: List[TextBlock|ImageBlock], deepresearch: bool = False, delta: bool = False) :
         self.id = str(uuid.uuid4())
         self.session_id = session_id
         self.content = content
         self.deepresearch = deepresearch
-        self.response_queue = asyncio.Queue()
+        self.delta = delta
+        self.response_queue = ResponseQueue() # 慢客户端下合并未下发的chunk，不随token数增长
         self.stream_task = None
         self.canceled = False
 
@@ -29,11 +31,6 @@ class AgentRequest:
             except:
                 pass
 
-class AgentStates:
-    def __init__(self, session_id: str, memory: MemoryBase):
-        self.session_id = session_id
-        self.memory = memory
-
 class PendingToolUse:
     PENDING = "pending"
     APPROVED = "approved"
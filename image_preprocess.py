@@ -0,0 +1,82 @@
+import asyncio
+import base64
+import binascii
+import io
+import math
+from typing import List
+
+from PIL import Image, ImageOps
+
+from blob_store import sniff_media_type
+from conf import IMAGE_PREPROCESS
+
+MEDIA_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+class InvalidImage(ValueError):
+    """图片无法解码（base64错误、文件截断或损坏）"""
+
+def preprocess_image(data: bytes, max_pixels: int, format: str, quality: int) -> tuple[bytes, str] | None:
+    """按像素预算缩小图片并重新压缩，丢弃EXIF等元数据；动图返回None（保持原样），无法解码时抛出InvalidImage"""
+    try: # PIL延迟解码，截断的文件在resize/save时才报错
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, "is_animated", False):
+            image.load() # 至少确认第一帧完整
+            return None
+        image = ImageOps.exif_transpose(image) # 丢弃EXIF前先按方向信息旋转
+        width, height = image.size
+        if width * height > max_pixels:
+            scale = math.sqrt(max_pixels / (width * height))
+            image = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if format == "JPEG" and has_alpha: # JPEG不支持透明通道，铺白底
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        out = io.BytesIO()
+        image.save(out, format=format, quality=quality, optimize=True)
+    except Exception as e:
+        raise InvalidImage(str(e)) from e
+    return out.getvalue(), MEDIA_TYPES[format]
+
+def _verify_image(data: bytes) -> bool:
+    try:
+        Image.open(io.BytesIO(data)).load()
+    except Exception:
+        return False
+    return True
+
+def preprocess_upload(data: bytes) -> bytes | None:
+    """/upload_image上传的原始字节：按配置预处理，不是PNG/JPEG/WebP/GIF图片或无法解码时返回None"""
+    if sniff_media_type(data) == "application/octet-stream":
+        return None
+    if not IMAGE_PREPROCESS["enable"]:
+        return data if _verify_image(data) else None
+    try:
+        result = preprocess_image(data, IMAGE_PREPROCESS["max_pixels"], IMAGE_PREPROCESS["format"], IMAGE_PREPROCESS["quality"])
+    except InvalidImage:
+        return None
+    return data if result is None else result[0]
+
+async def preprocess_content(content: List[dict]) -> List[dict]:
+    """在worker线程中处理请求里的base64图片，返回新的content列表，URL图片不处理；图片无法解码时抛出InvalidImage"""
+    if not IMAGE_PREPROCESS["enable"]:
+        return content
+    async def process(block: dict) -> dict:
+        source = block.get("source") or {}
+        if block.get("type") != "image" or source.get("type") != "base64":
+            return block
+        try:
+            data = base64.b64decode(source["data"])
+        except (binascii.Error, ValueError) as e:
+            raise InvalidImage(str(e)) from e
+        result = await asyncio.to_thread(
+            preprocess_image, data,
+            IMAGE_PREPROCESS["max_pixels"], IMAGE_PREPROCESS["format"], IMAGE_PREPROCESS["quality"],
+        )
+        if result is None:
+            return block
+        data, media_type = result
+        return {**block, "source": {"type": "base64", "media_type": media_type, "data": base64.b64encode(data).decode()}}
+    return list(await asyncio.gather(*(process(block) for block in content)))
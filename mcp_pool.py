@@ -0,0 +1,296 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, List, Literal
+
+import httpx
+import mcp.types
+from agentscope.mcp import HttpStatefulClient, HttpStatelessClient, MCPToolFunction, StdIOStatefulClient
+
+class MCPWrapper:
+    def __init__(self, client):
+        self.client = client
+        self.close_ev = asyncio.Event()
+        self.idle_since = time.time()
+
+    def trigger_close(self):
+        self.close_ev.set()
+
+    async def handle_close(self):
+        await self.close_ev.wait()
+        await self.client.close()
+
+class _CachedToolsMixin:
+    """缓存有状态client的tool列表和tool函数，重新connect或收到tools/list_changed通知时失效
+
+    每次失效tools_version递增，会话据此判断缓存的agent toolkit是否需要重建。
+    """
+    tools_version = 0
+    async def connect(self) -> None:
+        self.invalidate_tools()
+        await super().connect()
+        default_handler = self.session._message_handler
+        async def message_handler(message):
+            if isinstance(message, mcp.types.ServerNotification) and isinstance(message.root, mcp.types.ToolListChangedNotification):
+                self.invalidate_tools()
+            await default_handler(message)
+        self.session._message_handler = message_handler
+
+    def invalidate_tools(self):
+        self._cached_tools = None
+        self.funcs: Dict[str, MCPToolFunction] = {}
+        self.tools_version += 1
+
+    async def list_tools(self) -> List[mcp.types.Tool]:
+        self._validate_connection() # 连接已断开时抛错，会话注册失败后归还并重新借出
+        if self._cached_tools is not None:
+            return self._cached_tools
+        tools = await super().list_tools()
+        self.funcs = {}
+        return tools
+
+    async def get_callable_function(self, func_name: str, wrap_tool_result: bool = True, execution_timeout: float | None = None) -> MCPToolFunction:
+        if not wrap_tool_result or execution_timeout is not None:
+            return await super().get_callable_function(func_name, wrap_tool_result, execution_timeout)
+        func = self.funcs.get(func_name)
+        if func is None:
+            func = await super().get_callable_function(func_name, wrap_tool_result, execution_timeout)
+            self.funcs[func_name] = func
+        return func
+
+class CachedHttpStatefulClient(_CachedToolsMixin, HttpStatefulClient):
+    pass
+
+class CachedStdIOStatefulClient(_CachedToolsMixin, StdIOStatefulClient):
+    pass
+
+async def connect_stateful_mcp(type: Literal["stdio", "http"], name, **kwargs) -> MCPWrapper | None:
+    """在独立协程中连接有状态MCP，client的connect/close必须在同一个task内完成"""
+    q = asyncio.Queue()
+    async def mcp_lifecycle():
+        try:
+            if type == "http":
+                client = CachedHttpStatefulClient(name,**kwargs)
+            else:
+                client = CachedStdIOStatefulClient(name,**kwargs)
+            await client.connect()
+            mcp_wrapper = MCPWrapper(client)
+            await q.put(mcp_wrapper)
+            try:
+                await mcp_wrapper.handle_close()
+            except Exception:
+                pass
+        except BaseException as e:
+            print(f'{name} MCP Lifecycle Error: {e}')
+            await q.put(None)
+    asyncio.create_task(mcp_lifecycle())
+    return await q.get()
+
+class MCPClientPool:
+    """单个有状态MCP server的预热连接池
+
+    有状态client（如浏览器）借给会话后由会话独占，会话释放时关闭，不会被其他会话复用；
+    后台协程补充新连接，保持warm_size个空闲client。空闲超过idle_ttl的client被回收，
+    idle_ttl内没有借出过则不再补充，直到下一次acquire。
+    """
+    def __init__(self, name, type: Literal["stdio", "http"], warm_size: int, max_clients: int, idle_ttl: float, **kwargs):
+        self.name = name
+        self.type = type
+        self.kwargs = kwargs
+        self.warm_size = warm_size
+        self.max_clients = max_clients      # 借出+空闲+连接中的client总数上限
+        self.idle_ttl = idle_ttl
+        self.idle: deque[MCPWrapper] = deque()
+        self.total = 0
+        self.last_acquire = time.time()
+        self.refill_ev = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.refill_ev.set()
+            self.task = asyncio.create_task(self._maintain())
+
+    async def _connect(self) -> MCPWrapper | None:
+        self.total += 1
+        mcp_wrapper = await connect_stateful_mcp(self.type, self.name, **self.kwargs)
+        if mcp_wrapper is None:
+            self.total -= 1
+        return mcp_wrapper
+
+    async def acquire(self) -> MCPWrapper | None:
+        self.start()
+        self.last_acquire = time.time()
+        self.refill_ev.set()
+        if self.idle:
+            return self.idle.popleft()
+        if self.total >= self.max_clients:
+            print(f'{self.name} MCP pool is full ({self.max_clients})')
+            return None
+        return await self._connect()
+
+    def release(self, mcp_wrapper: MCPWrapper):
+        mcp_wrapper.trigger_close()
+        self.total -= 1
+        self.refill_ev.set()
+
+    async def _maintain(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.refill_ev.wait(), timeout=min(30, self.idle_ttl))
+            except asyncio.TimeoutError:
+                pass
+            self.refill_ev.clear()
+            now = time.time()
+            while self.idle and now - self.idle[0].idle_since > self.idle_ttl:
+                self.idle.popleft().trigger_close()
+                self.total -= 1
+            if now - self.last_acquire > self.idle_ttl: # 长时间没有需求，不再预热
+                continue
+            while len(self.idle) < self.warm_size and self.total < self.max_clients:
+                mcp_wrapper = await self._connect()
+                if mcp_wrapper is None: # 连接失败，等下一轮再试
+                    break
+                try:
+                    await mcp_wrapper.client.list_tools() # 预先拉取tool列表，会话注册时直接读缓存
+                except Exception as e:
+                    print(f'{self.name} MCP list_tools Error: {e}')
+                    mcp_wrapper.trigger_close()
+                    self.total -= 1
+                    break
+                self.idle.append(mcp_wrapper)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        while self.idle:
+            self.idle.popleft().trigger_close()
+            self.total -= 1
+
+class StatefulMCPPool:
+    """按MCP名称管理预热连接池，第一次acquire或warm时按传入的连接参数创建"""
+    def __init__(self, warm_size: int = 1, max_clients: int = 32, idle_ttl: float = 600):
+        self.warm_size = warm_size
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self.pools: Dict[str, MCPClientPool] = {}
+
+    def _pool(self, name, type: Literal["stdio", "http"], **kwargs) -> MCPClientPool:
+        pool = self.pools.get(name)
+        if pool is None:
+            pool = MCPClientPool(name, type, warm_size=self.warm_size, max_clients=self.max_clients, idle_ttl=self.idle_ttl, **kwargs)
+            self.pools[name] = pool
+        return pool
+
+    def warm(self, name, type: Literal["stdio", "http"], **kwargs):
+        """服务启动时预先连接，第一个会话无需等待"""
+        self._pool(name, type, **kwargs).start()
+
+    async def acquire(self, name, type: Literal["stdio", "http"], **kwargs) -> MCPWrapper | None:
+        return await self._pool(name, type, **kwargs).acquire()
+
+    def release(self, name, mcp_wrapper: MCPWrapper):
+        pool = self.pools.get(name)
+        if pool is not None:
+            pool.release(mcp_wrapper)
+        else:
+            mcp_wrapper.trigger_close()
+
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.close()
+
+class _SharedTransport(httpx.AsyncBaseTransport):
+    """多个AsyncClient共用的连接池，client退出时不关闭底层连接"""
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        pass
+
+class _CachedMCPToolFunction(MCPToolFunction):
+    """调用失败时让所属client的tool schema缓存失效，下一次注册重新拉取"""
+    def __init__(self, owner: "CachedStatelessClient", *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner = owner
+
+    async def __call__(self, **kwargs):
+        try:
+            return await super().__call__(**kwargs)
+        except Exception:
+            self.owner.invalidate()
+            raise
+
+class CachedStatelessClient(HttpStatelessClient):
+    """进程内共享的无状态MCP client：缓存tool schema（按TTL或调用出错时刷新），HTTP连接走共享连接池"""
+    def __init__(self, name: str, transport: Literal["streamable_http", "sse"], url: str, tools_ttl: float, http_transport: httpx.AsyncBaseTransport, **kwargs):
+        super().__init__(name, transport, url, httpx_client_factory=self._http_client_factory, **kwargs)
+        self.tools_ttl = tools_ttl
+        self.http_transport = http_transport
+        self.tools_fetched_at = 0.0
+        self.refresh_lock = asyncio.Lock()
+        self.funcs: Dict[str, _CachedMCPToolFunction] = {}
+
+    def _http_client_factory(self, headers: dict[str, str] | None = None, timeout: httpx.Timeout | None = None, auth: httpx.Auth | None = None) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=self.http_transport, headers=headers, timeout=timeout or httpx.Timeout(30, read=300), auth=auth, follow_redirects=True)
+
+    def invalidate(self):
+        self.tools_fetched_at = 0.0
+
+    async def list_tools(self) -> List[mcp.types.Tool]:
+        if self._tools is not None and time.time() - self.tools_fetched_at < self.tools_ttl:
+            return self._tools
+        async with self.refresh_lock: # 并发注册时只拉取一次
+            if self._tools is not None and time.time() - self.tools_fetched_at < self.tools_ttl:
+                return self._tools
+            try:
+                tools = await super().list_tools()
+            except Exception as e:
+                if self._tools is None:
+                    raise
+                print(f'{self.name} MCP list_tools Error, using cached tools: {e}')
+                self.tools_fetched_at = time.time() - self.tools_ttl / 2 # 降级使用旧缓存，稍后重试
+                return self._tools
+            self._tools = tools
+            self.tools_fetched_at = time.time()
+            self.funcs = {}
+            return tools
+
+    async def get_callable_function(self, func_name: str, wrap_tool_result: bool = True, execution_timeout: float | None = None) -> MCPToolFunction:
+        if not wrap_tool_result or execution_timeout is not None:
+            return await super().get_callable_function(func_name, wrap_tool_result, execution_timeout)
+        func = self.funcs.get(func_name)
+        if func is None:
+            tool = next((tool for tool in await self.list_tools() if tool.name == func_name), None)
+            if tool is None:
+                raise ValueError(f"Tool '{func_name}' not found in the MCP server ")
+            func = _CachedMCPToolFunction(self, mcp_name=self.name, tool=tool, wrap_tool_result=True, client_gen=self.get_client)
+            self.funcs[func_name] = func
+        return func
+
+class StatelessMCPRegistry:
+    """按名称共享的无状态MCP client，所有会话复用同一份tool schema和HTTP连接池"""
+    def __init__(self, tools_ttl: float = 600, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 60):
+        self.tools_ttl = tools_ttl
+        self.http_transport = _SharedTransport(httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )))
+        self.clients: Dict[str, CachedStatelessClient] = {}
+
+    def get(self, name: str, transport: Literal["streamable_http", "sse"], url: str, **kwargs) -> CachedStatelessClient:
+        client = self.clients.get(name)
+        if client is None:
+            client = CachedStatelessClient(name, transport, url, tools_ttl=self.tools_ttl, http_transport=self.http_transport, **kwargs)
+            self.clients[name] = client
+        return client
+
+    async def close(self):
+        await self.http_transport.transport.aclose()
+
+MCP_POOL = StatefulMCPPool(warm_size=1, max_clients=32, idle_ttl=600)
+MCP_REGISTRY = StatelessMCPRegistry(tools_ttl=600)
@@ -1,45 +1,433 @@
 import base64
+import copy
+import hashlib
+import importlib.util
 import io
+import json
+import os
+import struct
+from collections import OrderedDict
 from typing import List
+import httpx
 from PIL import Image
-from agentscope.model import OpenAIChatModel
+from agentscope.formatter import OpenAIChatFormatter
+from agentscope.message import Msg
+from agentscope.model import ChatResponse, OpenAIChatModel
 from agentscope.token import TokenCounterBase
+from blob_store import BLOB_STORE
+from conf import LLM_HTTP_POOL, TOKENIZER_FILE
+
+DASHSCOPE_BASE_URL = 'https://dashscope.aliyuncs.com/compatible-mode/v1'
+
+# 所有LLM client共用一个连接池，keep-alive复用TLS连接；安装了h2时启用HTTP/2
+LLM_HTTP_CLIENT = httpx.AsyncClient(
+    http2=LLM_HTTP_POOL["http2"] and importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(
+        max_connections=LLM_HTTP_POOL["max_connections"],
+        max_keepalive_connections=LLM_HTTP_POOL["max_keepalive_connections"],
+        keepalive_expiry=LLM_HTTP_POOL["keepalive_expiry"],
+    ),
+    timeout=httpx.Timeout(LLM_HTTP_POOL["timeout"], connect=LLM_HTTP_POOL["connect_timeout"]),
+    follow_redirects=True,
+)
+
+def llm_client_kwargs() -> dict:
+    """OpenAIChatModel的client_kwargs：DashScope兼容接口 + 共享连接池"""
+    return {'base_url': DASHSCOPE_BASE_URL, 'http_client': LLM_HTTP_CLIENT}
+
+def _jpeg_size(data: bytes) -> tuple[int, int] | None:
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF: # 填充字节
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9: # 没有长度字段的标记
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC): # SOFn
+            return struct.unpack(">H", data[i + 7:i + 9])[0], struct.unpack(">H", data[i + 5:i + 7])[0]
+        i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+def image_size(data: bytes) -> tuple[int, int] | None:
+    """从PNG/JPEG/WebP/GIF文件头读取(宽, 高)，不解码像素；无法识别或数据不完整返回None"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        return None
+    if data.startswith(b"\xff\xd8"):
+        return _jpeg_size(data)
+    return None
+
+def _update_data_url(h, url: str):
+    """data URL的内容指纹：长度、首尾各4KB和等间隔采样的字符，不需要遍历整个几MB的base64字符串"""
+    h.update(len(url).to_bytes(8, "little"))
+    h.update(url[:4096].encode())
+    h.update(url[-4096:].encode())
+    h.update(url[4096::1021].encode())
+
+class TextTokenizer:
+    """文本分词后端，批量返回每段文本的token数"""
+    name = "heuristic"
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [int(len(text) / 1.5) for text in texts] # 按字符数估算
+
+class TokenizerFile(TextTokenizer):
+    """本地tokenizer.json（HuggingFace tokenizers格式），Rust实现批量分词"""
+    name = "tokenizer.json"
+
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(path)
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(encoding.ids) for encoding in self.tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+def load_tokenizer(path: str = TOKENIZER_FILE) -> TextTokenizer:
+    """存在本地分词器文件且安装了tokenizers时使用它，否则按字符数估算"""
+    if path and os.path.exists(path):
+        try:
+            return TokenizerFile(path)
+        except Exception as e: # 没装tokenizers或文件损坏
+            print(f'load tokenizer {path} error, fallback to heuristic: {e}')
+    return TextTokenizer()
+
+_default_tokenizer: TextTokenizer | None = None
+
+def default_tokenizer() -> TextTokenizer:
+    """进程内共用一个分词器，第一次使用时加载"""
+    global _default_tokenizer
+    if _default_tokenizer is None:
+        _default_tokenizer = load_tokenizer()
+    return _default_tokenizer
 
 class VLTokenCounter(TokenCounterBase):
-    def __init__(self, *args, **kwargs):
+    """文本token由分词后端批量计算，图片按像素数估算
+
+    图片尺寸从文件头读取，按data URL的内容指纹缓存，长会话里的历史截图不再重复解码。
+    """
+    HEAD_CHARS = 65536 # 先只解码base64开头这部分，JPEG的SOF可能在EXIF之后，读不到再完整解码
+
+    def __init__(self, *args, tokenizer: TextTokenizer | None = None, max_images: int = 1024, **kwargs):
         super().__init__(*args, **kwargs)
+        self.tokenizer = tokenizer or default_tokenizer()
+        self.max_images = max_images
+        self.image_sizes: OrderedDict[bytes, tuple[int, int]] = OrderedDict() # 内容指纹 -> (宽, 高)
 
-    async def count(self, messages: List[dict], **kwargs) -> int:
-        total_tokens = 0
-        
-        for message in messages:
-            content = message.get("content", "")
+    def _image_size(self, url: str) -> tuple[int, int]:
+        h = hashlib.blake2b(digest_size=16)
+        _update_data_url(h, url)
+        key = h.digest()
+        size = self.image_sizes.get(key)
+        if size is not None:
+            self.image_sizes.move_to_end(key)
+            return size
+        start = url.index(",") + 1
+        size = None
+        if len(url) - start > self.HEAD_CHARS:
+            size = image_size(base64.b64decode(url[start:start + self.HEAD_CHARS]))
+        if size is None:
+            image_bytes = base64.b64decode(url[start:])
+            size = image_size(image_bytes)
+            if size is None:
+                size = Image.open(io.BytesIO(image_bytes)).size # 其他格式交给PIL，同样只读文件头
+        self.image_sizes[key] = size
+        if len(self.image_sizes) > self.max_images:
+            self.image_sizes.popitem(last=False)
+        return size
+
+    def count_each(self, messages: List[dict]) -> List[int]:
+        """逐条消息的token数，所有文本合并成一批交给分词后端"""
+        texts, owners = [], []
+        counts = [0] * len(messages)
+        for idx, message in enumerate(messages):
+            content = message.get("content") or ""
             if isinstance(content, str):
-                total_tokens += int(len(content) / 1.5)
+                texts.append(content)
+                owners.append(idx)
             elif isinstance(content, list):
                 for item in content:
                     item_type = item['type']
                     if item_type == "text":
-                        text = item['text']
-                        total_tokens += int(len(text) / 1.5)
+                        texts.append(item['text'])
+                        owners.append(idx)
                     elif item_type == "image_url":
                         url = item['image_url']['url']
                         if url.startswith("data:image"):
-                            base64_data = url.split(",")[1]
-                            image_bytes = base64.b64decode(base64_data)
-                            image = Image.open(io.BytesIO(image_bytes))
-                            width, height = image.size
-                            total_tokens += int((width * height) / (32 * 32))
+                            width, height = self._image_size(url)
+                            counts[idx] += int((width * height) / (32 * 32))
+            for tool_call in message.get("tool_calls") or []:
+                texts.append(tool_call['function']['arguments'])
+                owners.append(idx)
+        for idx, n in zip(owners, self.tokenizer.count_batch(texts) if texts else []):
+            counts[idx] += n
+        return counts
+
+    async def count(self, messages: List[dict], **kwargs) -> int:
+        return sum(self.count_each(messages))
+
+def compression_token_counter() -> TokenCounterBase:
+    """上下文压缩检查用的counter：加载了本地分词器时逐条缓存计数，按字符数估算本身比缓存查找更快，不包装"""
+    counter = VLTokenCounter()
+    if isinstance(counter.tokenizer, TokenizerFile):
+        return IncrementalTokenCounter(counter)
+    return counter
+
+class FormattedMessages(list):
+    """格式化结果，sources[i]为第i条消息的来源(来源key, 该Msg格式化出的第几条)，供IncrementalTokenCounter做缓存key"""
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.sources: List[tuple] = []
+
+def message_source(msg: Msg):
+    """来源key：一般为Msg id；纯文本消息取内容哈希，压缩摘要、系统提示词每次都以新id构造，仍能命中缓存"""
+    if isinstance(msg.content, str):
+        return ("text", hash(msg.content))
+    return msg.id
+
+def _block_version(block) -> tuple:
+    if not isinstance(block, dict):
+        return (None,)
+    if block.get("type") == "text":
+        return ("text", hash(block.get("text") or ""))
+    if block.get("type") == "image_url": # data URL每次格式化重新拼接，哈希需要扫描整张图片，只取长度
+        return ("image_url", len(block["image_url"]["url"]))
+    return (block.get("type"), len(block.get("input_audio", {}).get("data", "")))
+
+def message_version(message: dict) -> tuple:
+    """格式化后消息的版本号：role/name和文本、工具结果、工具调用参数的内容哈希，感知原地修改（包括等长修改）"""
+    content = message.get("content")
+    if isinstance(content, list):
+        content_sig = tuple(_block_version(block) for block in content)
+    else:
+        content_sig = hash(content) if isinstance(content, str) else None
+    tool_calls = tuple(hash(tool_call["function"]["arguments"]) for tool_call in message.get("tool_calls") or [])
+    return (message.get("role"), message.get("name"), content_sig, tool_calls)
+
+def message_fingerprint(message: dict) -> bytes:
+    """格式化后消息的内容哈希，图片data URL只取指纹；没有来源key时才使用"""
+    h = hashlib.blake2b(digest_size=16)
+    content = message.get("content")
+    blocks = content if isinstance(content, list) else [content]
+    for block in blocks:
+        if isinstance(block, dict) and block.get("type") == "image_url" and block["image_url"]["url"].startswith("data:"):
+            h.update(b"\0image\0")
+            _update_data_url(h, block["image_url"]["url"])
+        else:
+            h.update(b"\0block\0")
+            h.update(json.dumps(block, ensure_ascii=False, sort_keys=True).encode())
+    rest = {k: v for k, v in message.items() if k != "content"} # role/name/tool_calls/tool_call_id等
+    h.update(b"\0rest\0")
+    h.update(json.dumps(rest, ensure_ascii=False, sort_keys=True, default=str).encode())
+    return h.digest()
+
+class IncrementalTokenCounter(TokenCounterBase):
+    """逐条消息缓存token数，只对新增或变化的消息调用底层counter
+
+    压缩检查每次推理前都要统计整段历史，而每轮只追加少量消息。ReasoningHintFormatter的输出带有来源key，
+    以(来源key, 序号, message_version)作为缓存key；其他来源（如ReMe）的消息退回内容哈希。
+    总数是逐条计数之和，对带chat template的tokenizer会与整体计数有少量模板token的偏差。
+    """
+    def __init__(self, counter: TokenCounterBase, max_messages: int = 8192):
+        self.counter = counter
+        self.max_messages = max_messages
+        self.counts: OrderedDict[tuple | bytes, int] = OrderedDict() # 消息key -> token数
+
+    def _store(self, key: bytes, n: int):
+        self.counts[key] = n
+        if len(self.counts) > self.max_messages:
+            self.counts.popitem(last=False)
+
+    async def _cached(self, key: bytes, messages: List[dict], **kwargs) -> int:
+        n = self.counts.get(key)
+        if n is not None:
+            self.counts.move_to_end(key)
+            return n
+        n = await self.counter.count(messages, **kwargs)
+        self._store(key, n)
+        return n
+
+    async def count(self, messages: List[dict], tools: List[dict] | None = None, **kwargs) -> int:
+        sources = getattr(messages, "sources", None)
+        if sources is not None and len(sources) == len(messages):
+            keys = [(*source, message_version(message)) for source, message in zip(sources, messages)]
+        else:
+            keys = [message_fingerprint(message) for message in messages]
+        total_tokens = 0
+        count_each = getattr(self.counter, "count_each", None)
+        if count_each is not None: # 底层支持逐条计数时，未命中的消息合并成一批计算
+            missing = {key: message for key, message in zip(keys, messages) if key not in self.counts}
+            computed = dict(zip(missing, count_each(list(missing.values())))) if missing else {}
+            for key in keys:
+                n = computed.get(key)
+                if n is None:
+                    n = self.counts[key]
+                    self.counts.move_to_end(key)
+                total_tokens += n
+            for key, n in computed.items():
+                self._store(key, n)
+        else:
+            for key, message in zip(keys, messages):
+                total_tokens += await self._cached(key, [message], **kwargs)
+        if tools:
+            key = hashlib.blake2b(json.dumps(tools, ensure_ascii=False, sort_keys=True).encode(), digest_size=16).digest()
+            total_tokens += await self._cached(key, [], tools=tools, **kwargs)
         return total_tokens
 
-class OpenAIChatModelCached(OpenAIChatModel): 
+REASONING_HINT_NAME = "inner_hint"
+
+def _resolve_block(block: dict) -> dict:
+    if block.get("type") == "image":
+        return BLOB_STORE.resolve_block(block)
+    if block.get("type") == "tool_result" and isinstance(block.get("output"), list):
+        output = [_resolve_block(item) if isinstance(item, dict) else item for item in block["output"]]
+        if any(a is not b for a, b in zip(output, block["output"])):
+            return {**block, "output": output}
+    return block
+
+def _resolve_blobs(msg: Msg) -> Msg:
+    """memory里的消息只保存blob引用，格式化前在副本上换成base64，不修改memory"""
+    if isinstance(msg.content, str):
+        return msg
+    content = [_resolve_block(block) for block in msg.content]
+    if all(a is b for a, b in zip(content, msg.content)):
+        return msg
+    resolved = copy.copy(msg)
+    resolved.content = content
+    return resolved
+
+class ReasoningHintFormatter(OpenAIChatFormatter):
+    """推理提示在格式化时临时追加到末尾，不写入memory；blob图片引用在格式化时才还原为base64
+
+    hint由pre_reasoning hook设置、post_reasoning hook清除；追加的消息以REASONING_HINT_NAME命名，
+    OpenAIChatModelCached不会把缓存断点放在它上面，前缀缓存不受每轮变化的hint影响。
+    """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.hint: str | None = None
+
+    async def format(self, msgs: List[Msg], **kwargs) -> List[dict]:
+        msgs = [_resolve_blobs(msg) for msg in msgs]
+        if self.hint:
+            msgs = [*msgs, Msg(name=REASONING_HINT_NAME, content=self.hint, role="user")]
+        return await super().format(msgs, **kwargs)
+
+    async def _format(self, msgs: List[Msg]) -> FormattedMessages:
+        # 逐条格式化（OpenAIChatFormatter本身就逐条处理，结果一致），记录每条输出的来源Msg
+        messages = FormattedMessages()
+        for msg in msgs:
+            formatted = await super()._format([msg])
+            messages.extend(formatted)
+            source = message_source(msg)
+            messages.sources.extend((source, i) for i in range(len(formatted)))
+        return messages
+
+class CacheStats:
+    """上下文缓存命中统计，来自API usage的prompt_tokens_details.cached_tokens"""
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.last_call: dict = {}
+
+    def record(self, usage):
+        """累计一次调用的usage，last_call记录该次调用的prompt/cached tokens"""
+        if usage is None:
+            return
+        metadata = usage.metadata
+        details = metadata.get("prompt_tokens_details") if isinstance(metadata, dict) else getattr(metadata, "prompt_tokens_details", None)
+        cached = (details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", 0)) or 0
+        self.calls += 1
+        self.prompt_tokens += usage.input_tokens
+        self.cached_tokens += cached
+        self.last_call = {"prompt_tokens": usage.input_tokens, "cached_tokens": cached}
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "uncached_tokens": self.prompt_tokens - self.cached_tokens,
+            "hit_rate": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+            "last_call": self.last_call,
+        }
+
+CACHE_STATS = CacheStats()
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+def _with_cache_control(msg: dict) -> dict | None:
+    """返回带cache_control的消息副本；没有可标记的内容（如只有tool_calls的assistant消息）返回None"""
+    content = msg.get('content')
+    if isinstance(content, str) and content:
+        return {**msg, 'content': [{'type': 'text', 'text': content, 'cache_control': CACHE_CONTROL}]}
+    if isinstance(content, list) and content:
+        return {**msg, 'content': [*content[:-1], {**content[-1], 'cache_control': CACHE_CONTROL}]}
+    return None
+
+class OpenAIChatModelCached(OpenAIChatModel): 
+    """百炼显式上下文缓存：在多个位置放置cache_control断点，不修改调用方传入的messages
+
+    cache_breakpoints可选:
+    - "system": 系统提示词，跨轮次、跨会话稳定
+    - "summary": 系统提示词后的第一条消息，压缩后是摘要，未压缩时是首轮输入，直到下一次压缩前都不变
+    - "last": 最后一条稳定消息（跳过末尾临时追加的推理提示），下一次调用的前缀从这里复用
+    """
+    def __init__(self, *args, cache_breakpoints: tuple = ("system", "summary", "last"), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_breakpoints = cache_breakpoints
+
+    def _breakpoints(self, messages: List[dict]) -> List[int]:
+        indexes = []
+        first = 1 if messages and messages[0].get('role') == 'system' else 0
+        if "system" in self.cache_breakpoints and first == 1:
+            indexes.append(0)
+        if "summary" in self.cache_breakpoints and first < len(messages):
+            indexes.append(first)
+        if "last" in self.cache_breakpoints:
+            idx = len(messages) - 1
+            while idx > 0 and messages[idx].get('name') == REASONING_HINT_NAME:
+                idx -= 1
+            while idx >= 0 and _with_cache_control(messages[idx]) is None: # 向前找到可以标记的消息
+                idx -= 1
+            if idx >= 0:
+                indexes.append(idx)
+        return sorted(set(indexes))
 
     async def __call__(self, messages, *args, **kwargs): # 支持百炼上下文缓存
-        msg=messages[-1] # sample： {"role": "user", "content": {"type": "text", "text": "..."}, "cache_control": {"type": "ephemeral"}}}
-        if isinstance(msg['content'],str):
-            msg['content']=[{'type':'text','text':msg['content'], "cache_control": {"type": "ephemeral"}}]
-        else:
-            msg['content'][-1]['cache_control']= {"type": "ephemeral"}
-        return await super().__call__(messages, *args, **kwargs)
+        # sample： {"role": "user", "content": [{"type": "text", "text": "...", "cache_control": {"type": "ephemeral"}}]}
+        messages = list(messages)
+        for idx in self._breakpoints(messages):
+            marked = _with_cache_control(messages[idx])
+            if marked is not None:
+                messages[idx] = marked
+        res = await super().__call__(messages, *args, **kwargs)
+        if isinstance(res, ChatResponse):
+            self._record(res.usage)
+            return res
+        return self._record_stream(res)
+
+    def _record(self, usage):
+        CACHE_STATS.record(usage)
+
+    async def _record_stream(self, res):
+        usage = None
+        async for chunk in res:
+            usage = chunk.usage or usage
+            yield chunk
+        self._record(usage)
@@ -1,20 +1,25 @@
 import os
 import asyncio
+import hashlib
 import json
 from contextlib import asynccontextmanager
 import fastapi
-from agentscope.tool import Toolkit
-from fastapi import Request
-from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi import Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from datamodel import AgentRequest, ChatRequest
-from superagent import create_agent_if_not_exists, SESS_MGR, load_agent_states
-from tools import load_persona_file, modify_persona_file
+from superagent import create_agent_if_not_exists, SESS_MGR, load_history
+from tools import modify_persona_file, PROMPT_CACHE, SKILL_CATALOG
 from cron_manager import CRON_MGR
+from model import CACHE_STATS
+from image_preprocess import InvalidImage, preprocess_content, preprocess_upload
+from conf import IMAGE_PREPROCESS, SSE_STREAM
+from blob_store import BLOB_STORE, sniff_media_type
 from dotenv import load_dotenv
 import uvicorn
 from superagent import superagent_lifecycle
+from session_store import SESSION_STORE
 
 class AuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
@@ -35,7 +40,10 @@ class AuthMiddleware(BaseHTTPMiddleware):
 async def lifespan(app):
     async with SESS_MGR,superagent_lifecycle():
         await CRON_MGR.load_from_disk()
-        yield
+        try:
+            yield
+        finally:
+            await SESSION_STORE.flush() # 落盘write-behind中尚未写入的会话
 
 app=fastapi.FastAPI(lifespan=lifespan)
 
@@ -51,6 +59,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def make_etag(*parts) -> str:
+    """由资源版本标识生成ETag，版本不变时ETag不变"""
+    return '"' + hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest() + '"'
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    """If-None-Match命中时返回304，否则返回None"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+def etag_response(payload: dict, etag: str | None) -> JSONResponse:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag else {} # no-cache: 浏览器每次带If-None-Match重新验证
+    return JSONResponse(payload, headers=headers)
+
 @app.get("/")
 async def index():
     return FileResponse("chat.html")
@@ -73,15 +96,11 @@ async def get_music(filename: str, request: Request):
     )
 
 @app.get('/get_commands')
-async def get_commands():
-    toolkit=Toolkit()
-    for skill_dir in os.listdir(".agent/skills"):
-        if os.path.isdir(os.path.join(".agent/skills", skill_dir)):
-            try:
-                toolkit.register_agent_skill(os.path.join(".agent/skills", skill_dir))
-            except BaseException as e:
-                pass
-    skills_list = list(toolkit.skills.values())
+async def get_commands(request: Request):
+    etag = make_etag("commands", SKILL_CATALOG.version())
+    if (resp := not_modified(request, etag)) is not None:
+        return resp
+    skills_list = SKILL_CATALOG.skills()
 
     # Magic 命令列表
     magic_commands = [
@@ -89,15 +108,19 @@ async def get_commands():
         {"name": "reject", "description": "拒绝待确认的工具调用"}
     ]
 
-    return {"skills": skills_list, "magics": magic_commands}
+    return etag_response({"skills": skills_list, "magics": magic_commands}, etag)
 
 @app.get('/get_personas')
-async def get_personas():
-    return {
-        "agents": load_persona_file("AGENTS.md"),
-        "soul": load_persona_file("SOUL.md"),
-        "user": load_persona_file("USER.md"),
-    }
+async def get_personas(request: Request):
+    etag = make_etag("personas", PROMPT_CACHE.version())
+    if (resp := not_modified(request, etag)) is not None:
+        return resp
+    personas = PROMPT_CACHE.personas()
+    return etag_response({
+        "agents": personas["AGENTS.md"],
+        "soul": personas["SOUL.md"],
+        "user": personas["USER.md"],
+    }, etag)
 
 @app.post('/update_persona')
 async def update_persona(request: Request):
@@ -112,16 +135,36 @@ async def update_persona(request: Request):
     return {"status": "success"}
 
 @app.get("/get_crons")
-async def get_crons():
+async def get_crons(request: Request):
+    etag = make_etag("crons", CRON_MGR.version())
+    if (resp := not_modified(request, etag)) is not None:
+        return resp
     jobs = await CRON_MGR.list_crons()
-    return {"status": "success", "jobs": jobs}
+    return etag_response({"status": "success", "jobs": jobs}, etag)
+
+@app.get("/get_session_stats")
+async def get_session_stats():
+    return {"status": "success", "stats": SESS_MGR.stats()}
+
+@app.get("/get_model_stats")
+async def get_model_stats():
+    return {"status": "success", "stats": CACHE_STATS.stats()}
 
 @app.post("/chat")
 async def chat(request: ChatRequest):
+    for image_id in request.images:
+        if not BLOB_STORE.exists(image_id):
+            return {"error": "image_not_found", "image_id": image_id}
+    try:
+        content=await preprocess_content(request.content) # 缩小、重新压缩图片，减少上传和模型token
+    except InvalidImage as e:
+        return JSONResponse(status_code=400, content={"error": "invalid_image", "detail": str(e)})
+    content=await BLOB_STORE.externalize(content) # 图片存为blob，消息里只保留引用
+    content+=[{"type": "image", "source": {"type": "url", "url": BLOB_STORE.url(image_id)}} for image_id in request.images]
     queue_ok=False
     for _ in range(3):# 为session过期瞬间兜底
         sess = await create_agent_if_not_exists(request.session_id)
-        agent_req=AgentRequest(session_id=request.session_id, content=request.content, deepresearch=request.deepresearch)
+        agent_req=AgentRequest(session_id=request.session_id, content=content, deepresearch=request.deepresearch, delta=request.delta)
         if await sess.add_request(agent_req):
             queue_ok=True
             break
@@ -132,11 +175,14 @@ async def chat(request: ChatRequest):
     async def event_generator():
         yield f"data: {json.dumps({'request_id': agent_req.id})}\n\n"   # 首先发送request_id
         
+        window = SSE_STREAM["flush_ms"] / 1000
         while True:
-            msg = await agent_req.response_queue.get()
-            if msg is None:
+            batch = await agent_req.response_queue.get_batch(window) # flush窗口内的事件合并为一次写入
+            frames = "".join(f"data: {json.dumps(msg, ensure_ascii=False)}\n\n" for msg in batch if msg is not None)
+            if frames:
+                yield frames
+            if batch[-1] is None:
                 break
-            yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
     return StreamingResponse(event_generator(), media_type="text/event-stream")
     
 @app.get('/stop')
@@ -147,13 +193,59 @@ async def stop(session_id: str,request_id: str):
     await sess.cancel_request(request_id)
     return {"status": "canceled", "session_id": session_id, "request_id": request_id}
 
+@app.post('/upload_image')
+async def upload_image(request: Request):
+    max_bytes=IMAGE_PREPROCESS["max_upload_mb"]*1024*1024
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form=await request.form()
+        file=form.get("file")
+        if file is None or isinstance(file, str):
+            return Response(status_code=400, content="missing file")
+        if file.size is not None and file.size > max_bytes:
+            return Response(status_code=413, content="image too large")
+        data=await file.read()
+    else: # 原始字节，边接收边检查大小
+        data=bytearray()
+        async for chunk in request.stream():
+            data+=chunk
+            if len(data) > max_bytes:
+                return Response(status_code=413, content="image too large")
+        data=bytes(data)
+    if len(data) > max_bytes:
+        return Response(status_code=413, content="image too large")
+    processed=await asyncio.to_thread(preprocess_upload, data)
+    if processed is None:
+        return Response(status_code=415, content="unsupported image format")
+    image_id=await asyncio.to_thread(BLOB_STORE.put, processed)
+    return {"status": "success", "image_id": image_id, "url": BLOB_STORE.url(image_id)}
+
+@app.get('/blob/{blob_hash}')
+async def get_blob(blob_hash: str, request: Request):
+    etag=f'"{blob_hash}"'
+    visibility="private" if os.environ.get("SERVER_API_AUTH", "").lower() == "true" else "public" # 开启鉴权时不允许共享缓存保存
+    headers={"Cache-Control": f"{visibility}, max-age=31536000, immutable", "ETag": etag} # 内容寻址，同一hash的内容永不变化
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    data=await asyncio.to_thread(BLOB_STORE.get, blob_hash)
+    if data is None:
+        return Response(status_code=404, content="blob not found")
+    return Response(content=data, media_type=sniff_media_type(data), headers=headers)
+
 @app.get('/history')
-async def history(session_id: str):
-    states=await load_agent_states(session_id)
-    if states is None:
+async def history(request: Request, session_id: str, limit: int | None = Query(None, ge=1, le=1000), cursor: str | None = None, exclude_tools: bool = False, max_block_chars: int | None = Query(None, ge=1)):
+    version=await SESSION_STORE.version(session_id)
+    etag=None
+    if version is not None:
+        etag=make_etag("history", session_id, version, limit, cursor, exclude_tools, max_block_chars)
+        if (resp := not_modified(request, etag)) is not None:
+            return resp
+    try:
+        page=await load_history(session_id, limit=limit, cursor=cursor, exclude_tools=exclude_tools, max_block_chars=max_block_chars)
+    except KeyError:
+        return {"status": "invalid cursor", "session_id": session_id, "cursor": cursor}
+    if page is None:
         return {"status": "session not exists", "session_id": session_id}
-    history=await states.memory.get_memory(exclude_mark='compressed')
-    return {"status": "success", "session_id": session_id, "history": history}
+    return etag_response({"status": "success", "session_id": session_id, **page}, etag)
 
 if __name__ == "__main__":
     load_dotenv()
@@ -1,17 +1,21 @@
 import asyncio
+import heapq
+import itertools
 import time
 import uuid
+from collections import OrderedDict
 from enum import Enum
 from typing import Callable, Dict, Literal, List
 
-from agentscope.mcp import HttpStatefulClient, StdIOStatefulClient
+import psutil
 from agentscope.tool import Toolkit
 from agentscope_runtime.adapters.agentscope.tool import sandbox_tool_adapter
 from agentscope_runtime.engine.services.sandbox import SandboxService
 from agentscope_runtime.sandbox.box.sandbox import Sandbox
 
 from datamodel import AgentRequest, PendingToolUse
-from conf import FLAGS
+from mcp_pool import MCP_POOL, MCPWrapper
+from conf import FLAGS, SESSION_LIMITS
 
 BROWSER_TOOLS=[
     "browser_close",
@@ -43,20 +47,47 @@ class SessionStatus(Enum):
     ACTIVE = "ACTIVE"
     INACTIVE = "INACTIVE"
 
-class MCPWrapper:
-    def __init__(self, client):
-        self.client = client
-        self.close_ev = asyncio.Event()
+class ExpiryScheduler:
+    """会话过期调度：按deadline排序的小顶堆，单个后台协程只在最早的deadline到期时醒来
 
-    def trigger_close(self):
-        self.close_ev.set()
+    activate只更新last_activate，不调整堆；堆顶到期时再按最新的last_activate判断，未过期则按新deadline重新入堆。
+    """
+    def __init__(self):
+        self.heap: List[tuple[float, int, "Session"]] = []
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
 
-    async def handle_close(self):
-        await self.close_ev.wait()
-        await self.client.close()
+    def schedule(self, session: "Session"):
+        session.expiry_scheduled = True
+        heapq.heappush(self.heap, (session.deadline(), next(self.seq), session))
+        if self.heap[0][2] is session:  # 最早的deadline变了，唤醒调度协程重新计时
+            self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, session = heapq.heappop(self.heap)
+            if session.deadline() > time.time(): # 期间有活动，顺延
+                heapq.heappush(self.heap, (session.deadline(), next(self.seq), session))
+                continue
+            session.expiry_scheduled = False
+            asyncio.create_task(session.wake()) # 不在调度协程里等待session锁，避免被长时间持锁的操作阻塞
 
 class Session:
-    def __init__(self, session_id, sandbox_service, expires:float=60):
+    def __init__(self, session_id, sandbox_service, expires:float=60, expiry_scheduler: ExpiryScheduler | None=None):
         self.session_id = session_id
         self.lock = asyncio.Lock()
         self.cond = asyncio.Condition(self.lock)
@@ -66,9 +97,14 @@ class Session:
         self.req_queue=asyncio.Queue()
         self.last_activate = time.time()
         self.expires = expires
+        self.expiry_scheduler = expiry_scheduler
+        self.expiry_scheduled = False
+        self.evicted = False
         self.status=SessionStatus.ACTIVE
         self.pending_req: Dict[str, AgentRequest] = {} 
         self.pending_tool_calls: List[PendingToolUse] =[]
+        self.agent_ctx = None # superagent.AgentContext，跨请求复用
+        self.mcp_version = 0  # MCP/沙箱注册变化时递增，用于判断agent_ctx是否失效
 
     async def add_pending_tool(self, pending_tool: PendingToolUse):
         async with self.lock:
@@ -86,8 +122,25 @@ class Session:
                 return self.pending_tool_calls.pop(0)
             return None
 
+    def deadline(self) -> float:
+        return self.last_activate + self.expires
+
     def _activate(self):
         self.last_activate = time.time()
+        if self.expiry_scheduler is not None and not self.expiry_scheduled:
+            self.expiry_scheduler.schedule(self)
+
+    async def wake(self):
+        async with self.cond:
+            self.cond.notify()
+
+    def is_idle(self) -> bool:
+        return not self.pending_req
+
+    def evict(self):
+        """被GlobalSessionManager淘汰：runner按过期处理，走正常的落盘和资源释放流程"""
+        self.evicted = True
+        asyncio.create_task(self.wake())
 
     async def activate(self):
         async with self.lock:
@@ -106,12 +159,10 @@ class Session:
     async def get_request(self) -> tuple[AgentRequest|None, SessionStatus]:
         async with self.cond:
             while self.req_queue.empty():
-                try:
-                    await asyncio.wait_for(self.cond.wait(), timeout=1)  
-                except asyncio.TimeoutError:
-                    if time.time() - self.last_activate > self.expires:
-                        self.status = SessionStatus.INACTIVE    # agent coroutine拿到这个状态后，应该尽快销毁session
-                        return None, self.status
+                if self.evicted or time.time() >= self.deadline():
+                    self.status = SessionStatus.INACTIVE    # agent coroutine拿到这个状态后，应该尽快销毁session
+                    return None, self.status
+                await self.cond.wait() # 新请求或ExpiryScheduler到期时唤醒
             return await self.req_queue.get(), self.status
 
     async def finish_request(self,request: AgentRequest):
@@ -130,6 +181,7 @@ class Session:
             if self.sandbox is None:
                 sandboxes = self.sandbox_service.connect(session_id=self.session_id,sandbox_types=["browser"])
                 self.sandbox = sandboxes[0] # browser
+                self.mcp_version += 1
             for toolname in BROWSER_TOOLS:
                 tool=getattr(self.sandbox,toolname)
                 toolkit.register_tool_function(sandbox_tool_adapter(tool))
@@ -138,25 +190,8 @@ class Session:
     async def register_stateful_mcp(self, toolkit: Toolkit, type: Literal["stdio", "http"], name, **kwargs) -> bool:
         async with self.lock:
             if name not in self.mcp_wrappers:
-                q = asyncio.Queue()
-                async def mcp_lifecycle():
-                    try:
-                        if type == "http":
-                            client = HttpStatefulClient(name,**kwargs)
-                        else:
-                            client = StdIOStatefulClient(name,**kwargs)
-                        await client.connect()
-                        mcp_wrapper = MCPWrapper(client)
-                        await q.put(mcp_wrapper)
-                        try:
-                            await mcp_wrapper.handle_close()
-                        except Exception:
-                            pass
-                    except BaseException as e:
-                        print(f'{name} MCP Lifecycle Error: {e}')
-                        await q.put(None)
-                asyncio.create_task(mcp_lifecycle())
-                mcp_wrapper = await q.get()
+                mcp_wrapper = await MCP_POOL.acquire(name, type, **kwargs) # 优先从预热池借出已连接的client
+                self.mcp_version += 1
                 if mcp_wrapper is None:
                     return False
                 self.mcp_wrappers[name] = mcp_wrapper
@@ -164,31 +199,59 @@ class Session:
             try:
                 await toolkit.register_mcp_client(mcp_wrapper.client)
             except:
-                mcp_wrapper.trigger_close()
+                MCP_POOL.release(name, mcp_wrapper)
                 del self.mcp_wrappers[name]
+                self.mcp_version += 1
                 return False 
         return True
 
+    def mcp_tools_version(self) -> tuple:
+        """已注册的有状态MCP client的tool列表版本，收到tools/list_changed通知后变化"""
+        return tuple((name, getattr(mcp_wrapper.client, "tools_version", 0)) for name, mcp_wrapper in self.mcp_wrappers.items())
+
     async def release(self):
         async with self.lock:
             # mcp
-            for mcp_wrapper in self.mcp_wrappers.values():
+            for name, mcp_wrapper in self.mcp_wrappers.items():
                 try:
-                    mcp_wrapper.trigger_close()
+                    MCP_POOL.release(name, mcp_wrapper) # 有状态client不在会话间复用，关闭后由池补充新连接
                 except:
                     pass
             self.mcp_wrappers = {}
+            self.mcp_version += 1
+            self.agent_ctx = None
             # sandbox
             if self.sandbox is not None:
                 await self.sandbox_service.release(self.session_id)
 
-class GlobalSessionManager:
-    def __init__(self, enable_sandbox: bool = True, expires: float = 60):
-        self.manager_lock = asyncio.Lock()
+class SessionShard:
+    def __init__(self):
+        self.lock = asyncio.Lock() # 只保护本分片的创建/删除
         self.sessions: Dict[str, Session] = {}
+
+class GlobalSessionManager:
+    """按session_id哈希分片的会话表
+
+    查找已存在的会话不加锁（单线程事件循环内dict读取是原子的），创建和删除只锁对应分片；
+    session.activate()在分片锁之外执行，某个会话持锁做耗时操作（如连接MCP）不会阻塞其他会话。
+
+    创建会话时检查会话数上限和进程RSS预算，超出时按LRU淘汰空闲会话（正在处理请求的会话不淘汰）。
+    """
+    def __init__(self, enable_sandbox: bool = True, expires: float = 60, num_shards: int = 16, max_sessions: int = 0, max_rss_mb: float = 0):
+        self.shards = [SessionShard() for _ in range(num_shards)]
+        self.max_sessions = max_sessions    # 会话数上限，0表示不限制
+        self.max_rss_mb = max_rss_mb        # 进程RSS预算(MB)，0表示不限制
+        self.lru: OrderedDict[str, Session] = OrderedDict() # 未被淘汰的会话，最近访问的在末尾
+        self.process = psutil.Process()
+        self.rss_mb = 0.0
+        self.rss_sampled_at = 0.0
+        self.rss_batch_evicted = False
+        self.rss_batch_level: float | None = None # 上一次批量淘汰时的RSS，RSS回落之前不再批量淘汰
+        self.metrics = {"evicted_by_count": 0, "evicted_by_memory": 0, "evict_no_idle": 0}
         self.sandbox_service = SandboxService()
         self.enable_sandbox = enable_sandbox
         self.expires = expires
+        self.expiry_scheduler = ExpiryScheduler()
 
     async def __aenter__(self):
         if self.enable_sandbox:
@@ -198,25 +261,90 @@ class GlobalSessionManager:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         return
 
+    def _shard(self, session_id) -> SessionShard:
+        return self.shards[hash(session_id) % len(self.shards)]
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self.shards)
+
     async def get_or_create_session(self, session_id, create=True, session_main: Callable=None) -> Session: 
-        async with self.manager_lock: 
-            if session_id not in self.sessions:
-                if create:
-                    self.sessions[session_id] = Session(session_id, self.sandbox_service,expires=self.expires)
-                    asyncio.create_task(session_main(self.sessions[session_id]))
-            session = self.sessions.get(session_id,None)
-            if session is not None:
-                await session.activate()
-            return session
+        shard = self._shard(session_id)
+        session = shard.sessions.get(session_id,None)
+        if session is None and create:
+            async with shard.lock:
+                session = shard.sessions.get(session_id,None)
+                if session is None:
+                    session = Session(session_id, self.sandbox_service,expires=self.expires,expiry_scheduler=self.expiry_scheduler)
+                    shard.sessions[session_id] = session
+                    self.lru[session_id] = session
+                    asyncio.create_task(session_main(session))
+                    self._evict_if_needed(session)
+        elif session is not None and session_id in self.lru:
+            self.lru.move_to_end(session_id)
+        if session is not None:
+            await session.activate()
+        return session
 
     async def delete_session(self, session_id):
-        async with self.manager_lock:
-            if session_id in self.sessions:
-                del self.sessions[session_id]
+        shard = self._shard(session_id)
+        async with shard.lock:
+            if session_id in shard.sessions:
+                del shard.sessions[session_id]
+                self.lru.pop(session_id, None)
+
+    def _sample_rss(self) -> float:
+        now = time.time()
+        if now - self.rss_sampled_at >= 1: # 读RSS是系统调用，限频
+            self.rss_mb = self.process.memory_info().rss / 1024 / 1024
+            self.rss_sampled_at = now
+            self.rss_batch_evicted = False
+        return self.rss_mb
+
+    def _evict_if_needed(self, current: Session):
+        by_count = len(self.lru) - self.max_sessions if self.max_sessions else 0
+        by_memory = 0
+        if self.max_rss_mb and self._sample_rss() > self.max_rss_mb:
+            # 超出内存预算时新会话至少替换掉一个旧会话，并批量淘汰10%；CPython很少把释放的内存还给系统，
+            # 上一批淘汰后RSS没有回落就不再批量淘汰，否则RSS居高不下时每个采样周期都会再淘汰10%直到清空会话表
+            by_memory = 1
+            rss_dropped = self.rss_batch_level is None or self.rss_mb < self.rss_batch_level * 0.99
+            if not self.rss_batch_evicted and rss_dropped:
+                by_memory = max(1, len(self.lru) // 10)
+                self.rss_batch_evicted = True
+                self.rss_batch_level = self.rss_mb
+        elif self.max_rss_mb:
+            self.rss_batch_level = None
+        count = max(by_count, by_memory)
+        if count <= 0:
+            return
+
+        victims = []
+        for session in self.lru.values(): # 从最久未访问的开始
+            if len(victims) >= count:
+                break
+            if session is not current and session.is_idle():
+                victims.append(session)
+        for session in victims:
+            del self.lru[session.session_id] # 从registry删除由runner完成，期间到达的请求由/chat重试兜底
+            session.evict()
+        metric = "evicted_by_count" if by_count >= by_memory else "evicted_by_memory"
+        self.metrics[metric] += len(victims)
+        if len(victims) < count:
+            self.metrics["evict_no_idle"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self),
+            "live_sessions": len(self.lru),
+            "max_sessions": self.max_sessions,
+            "rss_mb": round(self._sample_rss(), 1),
+            "max_rss_mb": self.max_rss_mb,
+            **self.metrics,
+        }
 
     def temp_session(self):
         session_id = str(uuid.uuid4())
         return Session(session_id, self.sandbox_service)
 
 
-SESS_MGR = GlobalSessionManager(expires=300, enable_sandbox=FLAGS["enable_sandbox"])
+SESS_MGR = GlobalSessionManager(expires=SESSION_LIMITS["expires"], enable_sandbox=FLAGS["enable_sandbox"], max_sessions=SESSION_LIMITS["max_sessions"], max_rss_mb=SESSION_LIMITS["max_rss_mb"])
@@ -0,0 +1,357 @@
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, List
+
+from agentscope.memory import InMemoryMemory
+from agentscope.module import StateModule
+from agentscope.session import SessionBase
+
+class _ModuleTracker:
+    """记录某个state module上一次落盘时的状态，用于计算增量"""
+    def __init__(self):
+        self.msg_ids: List[str] = []            # InMemoryMemory: 消息顺序
+        self.msg_sigs: Dict[str, tuple] = {}    # InMemoryMemory: msg_id -> 签名
+        self.attrs_json: str = ""               # InMemoryMemory: content以外的状态(如_compressed_summary)
+        self.state_json: str = ""               # 其他module: 整个state_dict
+
+def _value_version(value) -> int:
+    """字段的廉价版本：可hash的值直接hash（str的hash缓存在对象上，只在首次计算），容器逐项组合"""
+    try:
+        return hash(value)
+    except TypeError:
+        pass
+    if isinstance(value, dict):
+        return hash(tuple([(k, _value_version(v)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple)):
+        return hash(tuple([_value_version(v) for v in value]))
+    return id(value)
+
+def _msg_version(msg) -> int:
+    content = msg.content
+    if isinstance(content, str):
+        content_version = hash(content)
+    else:
+        blocks = []
+        for block in content:
+            try:
+                blocks.append(hash(tuple(block.items()))) # 文本块的值都是str，不必逐层递归
+            except TypeError:
+                blocks.append(_value_version(block))
+        content_version = hash(tuple(blocks))
+    return hash((msg.name, msg.role, content_version, _value_version(msg.metadata), msg.timestamp))
+
+class _FrozenModule:
+    """在事件循环上截取的module状态，worker线程只读取它，不接触仍在被agent修改的对象
+
+    InMemoryMemory逐条序列化为(msg_id, msg_json, marks)：ReMe等组件会原地修改消息(如截断tool_result)，
+    只拷贝引用时worker线程可能读到修改中的对象。encoded按msg_id缓存(版本, JSON)，
+    版本不变的消息直接复用上一次的JSON，每次只序列化新增或变化的消息。
+    """
+    def __init__(self, module: StateModule, encoded: Dict[str, tuple] | None = None):
+        if isinstance(module, InMemoryMemory):
+            encoded = {} if encoded is None else encoded
+            current = {}
+            self.items = []
+            for msg, marks in module.content:
+                version = _msg_version(msg)
+                cached = encoded.get(msg.id)
+                msg_json = cached[1] if cached is not None and cached[0] == version else json.dumps(msg.to_dict(), ensure_ascii=False)
+                current[msg.id] = (version, msg_json)
+                self.items.append((msg.id, msg_json, tuple(marks)))
+            encoded.clear() # 只保留仍在memory中的消息
+            encoded.update(current)
+            self._sigs = None
+            self.attrs = _memory_attrs(module)
+            self.state = None
+        else:
+            self.items = None
+            self._sigs = None
+            self.attrs = None
+            self.state = json.dumps(module.state_dict(), ensure_ascii=False)
+
+    @property
+    def sigs(self) -> List[tuple]:
+        """消息内容哈希+marks，在worker线程中按需计算"""
+        if self._sigs is None:
+            self._sigs = [_msg_signature(msg_json, marks) for _, msg_json, marks in self.items]
+        return self._sigs
+
+    def state_dict(self) -> dict:
+        if self.items is None:
+            return json.loads(self.state)
+        return {**json.loads(self.attrs), "content": [[json.loads(msg_json), list(marks)] for _, msg_json, marks in self.items]}
+
+class _SessionJournal:
+    def __init__(self, gen: str, snapshot_bytes: int):
+        self.gen = gen
+        self.snapshot_bytes = snapshot_bytes
+        self.journal_bytes = 0
+        self.modules: Dict[str, _ModuleTracker] = {}
+        self.lock = asyncio.Lock()
+        self.pending: Dict[str, StateModule] | None = None     # 等待落盘的module，窗口内后写覆盖先写，落盘时才截取状态
+        self.encoded: Dict[str, Dict[str, tuple]] = {}          # module名 -> msg_id -> (版本, 消息JSON)
+        self.version = 0                                        # 最近一次save的序号，不等落盘
+        self.flush_task: asyncio.Task | None = None
+
+def _msg_signature(msg_json: str, marks: tuple) -> tuple:
+    return (hashlib.blake2b(msg_json.encode("utf-8", "surrogatepass"), digest_size=16).digest(), marks)
+
+def _memory_attrs(memory: InMemoryMemory) -> str:
+    # StateModule.state_dict不会序列化消息(content是原始列表引用)，开销很小
+    return json.dumps({k: v for k, v in StateModule.state_dict(memory).items() if k != "content"}, ensure_ascii=False)
+
+class JournalSession(SessionBase):
+    """追加写的session存储
+
+    磁盘布局:
+    - `<session_id>.json`: 快照，格式与JSONSession一致(额外的`_journal`字段记录快照代号)
+    - `<session_id>.journal.jsonl`: 快照之后的增量，每次落盘追加一行
+
+    InMemoryMemory只追加新增/变化的消息和删除的消息id，其他module在state变化时整体追加。
+    journal体积超过快照时做一次compaction重写快照，总写入量随历史长度线性增长。
+
+    save_session_state只记录module引用，save_delay内的多次save合并为一次落盘；落盘时在事件循环上截取一次状态
+    （只序列化新增或变化的消息），比对和文件IO在worker线程执行。读取前会先flush，session释放和服务退出时需要调用flush/close。
+    """
+    def __init__(self, save_dir: str = ".sessions", save_delay: float = 0.5, min_compact_bytes: int = 64 * 1024):
+        self.save_dir = save_dir
+        self.save_delay = save_delay
+        self.min_compact_bytes = min_compact_bytes
+        self._journals: Dict[str, _SessionJournal] = {}
+        self._instance = uuid.uuid4().hex   # 区分进程，重启后内存版本号重新计数
+        self._saves = 0                     # 所有session共用的save序号，journal被丢弃重建后也不会重复
+
+    def _snapshot_path(self, session_id: str) -> str:
+        return os.path.join(self.save_dir, f"{session_id}.json")
+
+    def _journal_path(self, session_id: str) -> str:
+        return os.path.join(self.save_dir, f"{session_id}.journal.jsonl")
+
+    def _journal(self, session_id: str) -> _SessionJournal:
+        journal = self._journals.get(session_id)
+        if journal is None:
+            journal = _SessionJournal(gen="", snapshot_bytes=0)
+            self._journals[session_id] = journal
+        return journal
+
+    async def save_session_state(self, session_id: str, user_id: str = "", **state_modules_mapping: StateModule) -> None:
+        journal = self._journal(session_id)
+        journal.pending = dict(state_modules_mapping)
+        self._saves += 1
+        journal.version = self._saves
+        if journal.flush_task is None or journal.flush_task.done():
+            journal.flush_task = asyncio.create_task(self._flush_later(session_id, journal))
+
+    async def _flush_later(self, session_id: str, journal: _SessionJournal):
+        await asyncio.sleep(self.save_delay)
+        try:
+            await self._flush(session_id, journal)
+        except Exception as e:
+            print(f"[SessionStore] Failed to save session {session_id}: {e}")
+
+    async def _flush(self, session_id: str, journal: _SessionJournal):
+        async with journal.lock:
+            pending, journal.pending = journal.pending, None
+            if pending is not None:
+                # 每个窗口只在事件循环上截取一次状态，之后的序列化比对和IO在worker线程
+                frozen = {name: _FrozenModule(module, journal.encoded.setdefault(name, {})) for name, module in pending.items()}
+                await asyncio.to_thread(self._write, session_id, journal, frozen)
+
+    async def flush(self, session_id: str | None = None):
+        """立即落盘等待中的状态，session_id为空时落盘全部session"""
+        session_ids = [session_id] if session_id is not None else list(self._journals)
+        for sid in session_ids:
+            journal = self._journals.get(sid)
+            if journal is not None:
+                await self._flush(sid, journal)
+
+    async def close_session(self, session_id: str):
+        """session从内存淘汰时落盘并丢弃增量追踪状态，之后的第一次save会重写快照"""
+        journal = self._journals.get(session_id)
+        if journal is None:
+            return
+        await self._flush(session_id, journal)
+        if journal.pending is None and self._journals.get(session_id) is journal:
+            del self._journals[session_id]
+
+    def _write(self, session_id: str, journal: _SessionJournal, modules: Dict[str, _FrozenModule]):
+        """在worker线程执行，调用方持有journal.lock"""
+        try:
+            entry = self._diff(journal, modules)
+            if entry is None:
+                self._write_snapshot(session_id, journal, modules)
+                return
+            if not entry:
+                return
+            line = json.dumps({"gen": journal.gen, **entry}, ensure_ascii=False) + "\n"
+            if journal.journal_bytes + len(line) > max(journal.snapshot_bytes, self.min_compact_bytes):
+                self._write_snapshot(session_id, journal, modules)
+                return
+            with open(self._journal_path(session_id), "a", encoding="utf-8", errors="surrogatepass") as f:
+                f.write(line)
+            journal.journal_bytes += len(line)
+        except BaseException:
+            journal.gen = "" # _diff已经更新了追踪状态但增量没有完整落盘，下一次save重写快照
+            raise
+
+    def _diff(self, journal: _SessionJournal, modules: Dict[str, _FrozenModule]) -> dict | None:
+        """计算相对上一次落盘的增量，返回None表示需要重写快照"""
+        if not journal.gen or set(modules) != set(journal.modules):
+            return None
+        entry = {}
+        for name, module in modules.items():
+            tracker = journal.modules[name]
+            if module.items is None:
+                if module.state != tracker.state_json:
+                    entry[name] = {"state": json.loads(module.state)}
+                    tracker.state_json = module.state
+                continue
+
+            cur_ids = [msg_id for msg_id, _, _ in module.items]
+            cur_set = set(cur_ids)
+            deleted = [msg_id for msg_id in tracker.msg_ids if msg_id not in cur_set]
+            deleted_set = set(deleted)
+            surviving = [msg_id for msg_id in tracker.msg_ids if msg_id not in deleted_set]
+            if cur_ids[:len(surviving)] != surviving: # 顺序发生变化，无法用追加表达
+                return None
+
+            module_entry = {}
+            put, add = [], []
+            for idx, ((msg_id, msg_json, marks), sig) in enumerate(zip(module.items, module.sigs)):
+                if tracker.msg_sigs.get(msg_id) == sig:
+                    continue
+                (put if idx < len(surviving) else add).append([json.loads(msg_json), list(marks)])
+                tracker.msg_sigs[msg_id] = sig
+            for msg_id in deleted:
+                tracker.msg_sigs.pop(msg_id, None)
+            tracker.msg_ids = cur_ids
+            if deleted:
+                module_entry["del"] = deleted
+            if put:
+                module_entry["put"] = put
+            if add:
+                module_entry["add"] = add
+            if module.attrs != tracker.attrs_json:
+                module_entry["attrs"] = json.loads(module.attrs)
+                tracker.attrs_json = module.attrs
+            if module_entry:
+                entry[name] = module_entry
+        return entry
+
+    def _write_snapshot(self, session_id: str, journal: _SessionJournal, modules: Dict[str, _FrozenModule]):
+        os.makedirs(self.save_dir, exist_ok=True)
+        gen = uuid.uuid4().hex
+        state_dicts = {name: module.state_dict() for name, module in modules.items()}
+        state_dicts["_journal"] = {"gen": gen}
+        content = json.dumps(state_dicts, ensure_ascii=False)
+
+        snapshot_path = self._snapshot_path(session_id)
+        tmp_path = f"{snapshot_path}.{gen}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8", errors="surrogatepass") as f:
+                f.write(content)
+            os.replace(tmp_path, snapshot_path) # 快照原子替换后旧journal的gen不再匹配，即使删除失败也不会被回放
+        except BaseException:
+            try:
+                os.remove(tmp_path) # 写满磁盘等失败时不留下半截的临时文件
+            except OSError:
+                pass
+            raise
+        try:
+            os.remove(self._journal_path(session_id))
+        except FileNotFoundError:
+            pass
+
+        journal.gen = gen
+        journal.snapshot_bytes = len(content)
+        journal.journal_bytes = 0
+        journal.modules = {}
+        for name, module in modules.items():
+            tracker = _ModuleTracker()
+            if module.items is not None:
+                tracker.msg_ids = [msg_id for msg_id, _, _ in module.items]
+                tracker.msg_sigs = {msg_id: sig for (msg_id, _, _), sig in zip(module.items, module.sigs)}
+                tracker.attrs_json = module.attrs
+            else:
+                tracker.state_json = module.state
+            journal.modules[name] = tracker
+
+    def _read_states(self, session_id: str) -> dict | None:
+        snapshot_path = self._snapshot_path(session_id)
+        if not os.path.exists(snapshot_path):
+            return None
+        with open(snapshot_path, "r", encoding="utf-8", errors="surrogatepass") as f:
+            states = json.loads(f.read())
+        gen = states.pop("_journal", {}).get("gen")
+
+        journal_path = self._journal_path(session_id)
+        if gen and os.path.exists(journal_path):
+            with open(journal_path, "r", encoding="utf-8", errors="surrogatepass") as f:
+                lines = f.read().splitlines()
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError: # 进程崩溃时最后一行可能不完整
+                    continue
+                if entry.pop("gen", None) != gen:
+                    continue
+                for name, module_entry in entry.items():
+                    _apply_entry(states, name, module_entry)
+        return states
+
+    async def version(self, session_id: str) -> tuple | None:
+        """session状态的版本，不触发落盘；session不存在时返回None
+
+        内存中有追踪状态时为最近一次save的序号，否则为快照和journal文件的(mtime_ns, size)。
+        """
+        journal = self._journals.get(session_id)
+        if journal is not None:
+            return (self._instance, journal.version)
+        versions = []
+        for path in (self._snapshot_path(session_id), self._journal_path(session_id)):
+            try:
+                st = os.stat(path)
+                versions.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                versions.append(None)
+        return tuple(versions) if versions[0] is not None else None
+
+    async def load_states(self, session_id: str) -> dict | None:
+        """读取快照并回放journal，返回合并后的state_dict；session不存在时返回None"""
+        await self.flush(session_id)
+        return await asyncio.to_thread(self._read_states, session_id)
+
+    async def load_session_state(self, session_id: str, user_id: str = "", allow_not_exist: bool = True, **state_modules_mapping: StateModule) -> None:
+        states = await self.load_states(session_id)
+        if states is None:
+            if allow_not_exist:
+                return
+            raise ValueError(f"Failed to load session state for session {session_id} does not exist.")
+        for name, state_module in state_modules_mapping.items():
+            if name in states:
+                state_module.load_state_dict(states[name])
+
+def _apply_entry(states: dict, name: str, module_entry: dict):
+    if "state" in module_entry:
+        states[name] = module_entry["state"]
+        return
+    module_state = states.setdefault(name, {"content": []})
+    content = module_state.setdefault("content", [])
+    if "del" in module_entry:
+        deleted = set(module_entry["del"])
+        content[:] = [item for item in content if item[0].get("id") not in deleted]
+    index = {item[0].get("id"): i for i, item in enumerate(content)}
+    for item in module_entry.get("put", []) + module_entry.get("add", []):
+        msg_id = item[0].get("id")
+        if msg_id in index:
+            content[index[msg_id]] = item
+        else:
+            index[msg_id] = len(content)
+            content.append(item)
+    if "attrs" in module_entry:
+        module_state.update(module_entry["attrs"])
+
+SESSION_STORE = JournalSession(save_dir=".sessions")
@@ -0,0 +1,169 @@
+import asyncio
+import json
+from collections import deque
+from typing import Dict, List
+from agentscope.message import Msg
+
+def msg_to_contents(msg: Msg) -> List[dict]:
+    """将agent打印的Msg转换为SSE下发的contents结构"""
+    contents=[]
+    for content in msg.content:
+        if content['type']=='text':
+            contents.append({"type": "text", "content": content['text']})
+        elif content['type']=='tool_use':
+            contents.append({"type": "tool_use", "tool_use_id": content["id"], "content": f'{content["name"]}: {json.dumps(content["input"], ensure_ascii=False)}'})
+        elif content['type']=='tool_result':
+            contents.append({"type": "tool_result", "tool_use_id": content["id"], "content": f'{content["name"]}: {json.dumps(content["output"], ensure_ascii=False)}'})
+    return contents
+
+class DeltaEncoder:
+    """增量编码器: 按msg_id记录已下发的contents，只输出相对上一次的变化
+
+    每个变化的内容块输出为 {"index": 块下标, "type": ..., "delta": 追加文本} ，
+    如果新内容不是旧内容的前缀扩展（例如tool_use的input在流式解析中被改写），则输出 {"index": ..., "type": ..., "content": 完整内容} 整块替换。
+    """
+    def __init__(self):
+        self._sent: Dict[str, List[dict]] = {}
+
+    def encode(self, msg_id: str, contents: List[dict]) -> List[dict]:
+        sent = self._sent.get(msg_id, [])
+        delta = []
+        for index, block in enumerate(contents):
+            prev = sent[index] if index < len(sent) else None
+            if prev == block:
+                continue
+            entry = {k: v for k, v in block.items() if k != 'content'}
+            entry['index'] = index
+            if prev is not None and prev['type'] == block['type'] and block['content'].startswith(prev['content']):
+                entry['delta'] = block['content'][len(prev['content']):]
+            else:
+                entry['content'] = block['content']
+            delta.append(entry)
+        self._sent[msg_id] = contents
+        return delta
+
+    def finish(self, msg_id: str):
+        self._sent.pop(msg_id, None)
+
+class PlanEvents:
+    """plan变化事件: 只在plan实际变化时生成一条独立事件，普通消息chunk不再携带plan
+
+    事件为 {"msg_id": None, "last": False, "contents": [], "plan": 完整plan或None, "plan_version": 版本号}，
+    版本号在一次请求的流内从1递增，客户端据此丢弃乱序事件、发现缺失。
+    """
+    def __init__(self):
+        self.version = 0
+        self._last: str | None = None
+
+    def event(self, plan) -> dict | None:
+        dump = plan.model_dump() if plan is not None else None
+        key = json.dumps(dump, ensure_ascii=False, sort_keys=True)
+        if key == self._last:
+            return None
+        self._last = key
+        self.version += 1
+        return {"msg_id": None, "last": False, "contents": [], "plan": dump, "plan_version": self.version}
+
+def _stream_key(msg: dict):
+    """可合并事件所属的流：plan事件为'plan'，普通chunk为msg_id；cancel/error等不合并"""
+    if 'cancel' in msg or 'error' in msg:
+        return None
+    if 'plan_version' in msg:
+        return 'plan'
+    return msg.get('msg_id')
+
+def _apply_delta(contents: List[dict], entries: List[dict]) -> List[dict]:
+    contents = [dict(block) for block in contents]
+    for entry in entries:
+        block = {k: v for k, v in entry.items() if k not in ('index', 'delta')}
+        if 'delta' in entry:
+            contents[entry['index']]['content'] += entry['delta']
+        elif entry['index'] < len(contents):
+            contents[entry['index']] = block
+        else:
+            contents.append(block)
+    return contents
+
+def _merge_delta(entries: List[dict], newer: List[dict]) -> List[dict]:
+    merged = {entry['index']: dict(entry) for entry in entries}
+    for entry in newer:
+        prev = merged.get(entry['index'])
+        if 'delta' in entry and prev is not None: # 追加到未下发的delta或整块内容上
+            prev['delta' if 'delta' in prev else 'content'] += entry['delta']
+        else:
+            merged[entry['index']] = dict(entry)
+    return [merged[index] for index in sorted(merged)]
+
+def merge_events(queued: dict, msg: dict) -> dict | None:
+    """把新事件合并进同一流中尚未下发的事件，返回合并结果；不能合并时返回None
+
+    plan事件是完整快照，新的直接覆盖旧的；消息chunk在旧chunk不是last时合并：
+    新chunk是完整内容则覆盖，是增量则按内容块下标拼接到旧chunk上。
+    """
+    key = _stream_key(msg)
+    if key is None or _stream_key(queued) != key:
+        return None
+    if key == 'plan':
+        return msg
+    if queued['last']:
+        return None
+    if not msg.get('delta'):
+        return msg
+    if queued.get('delta'):
+        return {**msg, 'contents': _merge_delta(queued['contents'], msg['contents'])}
+    return {k: v for k, v in msg.items() if k != 'delta'} | {'contents': _apply_delta(queued['contents'], msg['contents'])}
+
+class ResponseQueue:
+    """SSE响应队列: 写入时与同一流中尚未下发的事件合并，慢客户端下每条消息最多积压一个待发快照
+
+    队列长度只随已结束的消息数增长，与token数无关；None为结束标记。
+    get_batch拿到事件后再等待一个flush窗口，窗口内到达的chunk继续在队列中合并，然后一次取出。
+    """
+    def __init__(self):
+        self._items: deque = deque()
+        self._ready = asyncio.Event()
+        self._closed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def put(self, msg: dict | None):
+        if msg is None:
+            self._closed.set()
+        elif _stream_key(msg) is not None:
+            for index in range(len(self._items) - 1, -1, -1): # 找同一流中最近的一条，之间的其他流事件互不影响
+                queued = self._items[index]
+                if queued is None:
+                    break
+                if _stream_key(queued) != _stream_key(msg):
+                    continue
+                merged = merge_events(queued, msg)
+                if merged is not None:
+                    self._items[index] = merged
+                    return
+                break
+        self._items.append(msg)
+        self._ready.set()
+
+    async def get(self) -> dict | None:
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.popleft()
+
+    async def get_batch(self, window: float) -> List[dict | None]:
+        """等待事件，再等待window秒（收到结束标记时立即返回），取出截至结束标记的全部事件"""
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        if window > 0 and not self._closed.is_set():
+            try:
+                await asyncio.wait_for(self._closed.wait(), window)
+            except asyncio.TimeoutError:
+                pass
+        batch = []
+        while self._items:
+            batch.append(self._items.popleft())
+            if batch[-1] is None:
+                break
+        return batch
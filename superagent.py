@@ -1,42 +1,51 @@
 import asyncio
 from contextlib import asynccontextmanager
-import json
 import os
 import sys
 import traceback
 from datetime import datetime
+from typing import List
 from agentscope import plan
 from agentscope.agent import ReActAgent
-from agentscope.formatter import OpenAIChatFormatter
 from agentscope.memory import InMemoryMemory
 from agentscope.message import Msg
 from agentscope.model import OpenAIChatModel
 from agentscope.pipeline import stream_printing_messages
 from agentscope.plan import PlanNotebook
-from agentscope.session import JSONSession
-from model import OpenAIChatModelCached, VLTokenCounter
+from agentscope.tool import Toolkit
+from model import IncrementalTokenCounter, OpenAIChatModelCached, ReasoningHintFormatter, compression_token_counter, llm_client_kwargs, LLM_HTTP_CLIENT
 from session import Session, SessionStatus, SESS_MGR
-from tools import build_agent_toolkit, build_subagent_tool, SUBAGENT_PROMPT, REME_PROMPT, AGENT_PERSONA_PROMPT,CRON_PROMPT, REASONING_HINT_TEMPLATE, init_reme, format_system_prompt
+from mcp_pool import MCP_POOL, MCP_REGISTRY
+from session_store import SESSION_STORE
+from blob_store import BLOB_STORE
+from tools import build_agent_toolkit, build_subagent_tool, SUBAGENT_PROMPT, REME_PROMPT, AGENT_PERSONA_PROMPT,CRON_PROMPT, REASONING_HINT_TEMPLATE, init_reme, format_system_prompt, persona_version, skills_version, stateful_mcp_configs
 from conf import FLAGS
-from datamodel import AgentStates,AgentRequest,PendingToolUse
+from datamodel import AgentRequest,PendingToolUse
+from stream import DeltaEncoder, PlanEvents, msg_to_contents
 from openclaw import OpenClaw
 from agentscope import setup_logger
 if FLAGS["enable_reme"]:
     from reme.reme_light import ReMeInMemoryMemory
 
-global reme, hf_token_counter
+global reme, hf_token_counter, reme_token_counter
 
 @asynccontextmanager
 async def superagent_lifecycle():
-    global reme, hf_token_counter
+    global reme, hf_token_counter, reme_token_counter
     setup_logger(level="WARNING")
     try:    
         os.makedirs(".agent/skills/",exist_ok=True)
         if FLAGS["enable_reme"]:
             reme, hf_token_counter = init_reme()
+            reme_token_counter = IncrementalTokenCounter(hf_token_counter) # HuggingFace分词远慢于缓存查找，压缩检查只对新消息分词
             await reme.start()
+        for name, config in stateful_mcp_configs().items(): # 预热有状态MCP，首个请求无需等待连接
+            MCP_POOL.warm(name, **config)
         yield
     finally:
+        await MCP_POOL.close()
+        await MCP_REGISTRY.close()
+        await LLM_HTTP_CLIENT.aclose()
         if FLAGS["enable_reme"]:
             await reme.close()
 
@@ -46,7 +55,7 @@ async def register_reme(agent: ReActAgent):
         msg_to_keep,compressed_summary=await reme.pre_reasoning_hook(
             messages=messages, 
             compressed_summary=agent.memory._compressed_summary,
-            as_token_counter=hf_token_counter,
+            as_token_counter=reme_token_counter,
             system_prompt=agent.sys_prompt,
             max_input_length=100*1000, # qwen3.5 100K context window
             compact_ratio=0.6,
@@ -62,15 +71,15 @@ async def register_reme(agent: ReActAgent):
     agent.register_instance_hook('pre_reasoning','reme_pre_reasoning',reme_pre_reasoning)
 
 async def register_reasoning_hint(agent: ReActAgent):
+    # hint只在格式化时追加到prompt末尾(ReasoningHintFormatter)，不写入memory；时间精确到分钟
     async def add_reasoning_hint(agent: ReActAgent,kwargs):
         now = datetime.now()
         weekday_map = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
         weekday = weekday_map[now.weekday()]
-        current_time = now.strftime(f"%Y年%m月%d日 {weekday} %H:%M:%S")
-        hint_content = REASONING_HINT_TEMPLATE.format(current_time=current_time)
-        await agent.memory.add(Msg(name="inner_hint", content=hint_content, role="user"), marks='MY_REASONING_HINT')
+        current_time = now.strftime(f"%Y年%m月%d日 {weekday} %H:%M")
+        agent.formatter.hint = REASONING_HINT_TEMPLATE.format(current_time=current_time)
     async def remove_reasoning_hint(agent: ReActAgent,kwargs,output=None):
-        await agent.memory.delete_by_mark(mark='MY_REASONING_HINT')
+        agent.formatter.hint = None
     agent.register_instance_hook('pre_reasoning','add_reasoning_hint',add_reasoning_hint)
     agent.register_instance_hook('post_reasoning','remove_reasoning_hint',remove_reasoning_hint)
 
@@ -80,6 +89,16 @@ async def register_sess_keepalive(agent: ReActAgent,sess: Session):
     for hooks in ['pre_reasoning', 'pre_acting', 'post_acting', 'post_reasoning']:
         agent.register_instance_hook(hooks,'activate_sess_client',activate_sess_client)
 
+async def register_tool_image_externalize(agent: ReActAgent):
+    # 工具结果里的图片（如浏览器截图）写入blob存储，memory、会话快照和journal只保留引用
+    async def externalize_tool_images(agent: ReActAgent,kwargs,output=None):
+        tool_call_id=kwargs['tool_call']['id']
+        for msg,_ in reversed(getattr(agent.memory,'content',[])):
+            if any(block.get('type')=='tool_result' and block.get('id')==tool_call_id for block in msg.get_content_blocks()):
+                await BLOB_STORE.externalize_tool_results(msg)
+                break
+    agent.register_instance_hook('post_acting','externalize_tool_images',externalize_tool_images)
+
 async def register_memory_autosave(agent: ReActAgent,sess: Session):
     first_reasoning=True
     async def autosave_session(agent:ReActAgent,kwargs):
@@ -108,16 +127,106 @@ async def handle_magic_command(request: AgentRequest, sess: Session):
                 pending_tool.status=PendingToolUse.REJECTED
 
 async def save_session(session_id, **kwargs):
-    jsonSession=JSONSession(save_dir=".sessions")
     state_dict={}
     for k,v in kwargs.items():
         if v is not None:
             state_dict[k]=v
-    return await jsonSession.save_session_state(session_id=session_id,**state_dict)
+    return await SESSION_STORE.save_session_state(session_id=session_id,**state_dict)
 
 async def load_session(session_id,**kwargs):
-    jsonSession=JSONSession(save_dir=".sessions")
-    return await jsonSession.load_session_state(session_id=session_id,**kwargs)
+    return await SESSION_STORE.load_session_state(session_id=session_id,**kwargs)
+
+class AgentContext:
+    """会话级agent上下文：toolkit、模型客户端、formatter、记忆跨请求复用，fingerprint变化时重建"""
+    def __init__(self, fingerprint, toolkit: Toolkit, sys_prompt: str, model, formatter, compression_config):
+        self.fingerprint = fingerprint
+        self.toolkit = toolkit
+        self.sys_prompt = sys_prompt
+        self.model = model
+        self.formatter = formatter
+        self.compression_config = compression_config
+        self.memory = None
+        self.plan_notebook = None
+        self.plan_tools: List[str] = []
+
+    def reset_states(self):
+        # 请求异常/被打断时内存中的记忆可能不完整，丢弃后从磁盘恢复
+        self.memory = None
+        self.plan_notebook = None
+        self.formatter.hint = None # _reasoning异常/取消时post_reasoning不会执行
+
+def agent_context_fingerprint(sess: Session):
+    # skills、人格文件、FLAGS、MCP注册及其tool列表任一变化都需要重建agent上下文
+    return (tuple(FLAGS.items()), skills_version(), persona_version(), sess.mcp_version, sess.mcp_tools_version())
+
+async def build_agent_context(sess: Session, fingerprint) -> AgentContext:
+    toolkit=await build_agent_toolkit(sess)
+
+    extra_sys_prompt = [AGENT_PERSONA_PROMPT, CRON_PROMPT]
+    if FLAGS["enable_subagent"]:
+        toolkit.register_tool_function(await build_subagent_tool())
+        extra_sys_prompt.append(SUBAGENT_PROMPT)
+    if FLAGS["enable_reme"]:
+        extra_sys_prompt.append(REME_PROMPT)
+
+    compression_config=None
+    if not FLAGS["enable_reme"]:
+        compression_config=ReActAgent.CompressionConfig(
+            enable=True,
+            agent_token_counter=compression_token_counter(),
+            trigger_threshold=60*1000,
+            keep_recent=3,
+            compression_model=OpenAIChatModel(
+                 # 百炼只有部分模型支持json schema: https://bailian.console.aliyun.com/cn-beijing/?spm=5176.29619931.J_PvCec88exbQTi-U433Fxg.4.74cd10d7jGKMNJ&tab=doc#/doc/?type=model&url=2862209
+                model_name="qwen-plus",
+                api_key=os.environ["DASHSCOPE_API_KEY"],
+                stream=False,
+                client_kwargs=llm_client_kwargs(),
+                generate_kwargs={
+                    'extra_body': {
+                        'enable_thinking': False,
+                    }
+                }
+            ),
+        )
+
+    return AgentContext(
+        fingerprint=fingerprint,
+        toolkit=toolkit,
+        sys_prompt=format_system_prompt(extra_sys_prompt),
+        model=OpenAIChatModelCached(
+            model_name="qwen3.6-plus",
+            api_key=os.environ["DASHSCOPE_API_KEY"],
+            stream=True,
+            client_kwargs=llm_client_kwargs(),
+            generate_kwargs={
+                'extra_body': {
+                    'enable_thinking': False,
+                    'enable_search': True,
+                    'search_options': {
+                        'enable_search_extension': True,
+                        'forced_search': True,
+                    },
+                }
+            }
+        ),
+        formatter=ReasoningHintFormatter(),
+        compression_config=compression_config,
+    )
+
+async def get_agent_context(sess: Session) -> AgentContext:
+    # fingerprint在构建前计算：构建过程中MCP注册发生变化（首次连接/连接失败）时，下一次请求会再重建一次
+    fingerprint=agent_context_fingerprint(sess)
+    ctx=sess.agent_ctx
+    if ctx is None or ctx.fingerprint!=fingerprint:
+        new_ctx=await build_agent_context(sess, fingerprint)
+        if ctx is not None: # 记忆和planning与toolkit无关，沿用
+            new_ctx.memory, new_ctx.plan_notebook = ctx.memory, ctx.plan_notebook
+        sess.agent_ctx=ctx=new_ctx
+    if ctx.memory is None:
+        ctx.memory=ReMeInMemoryMemory(hf_token_counter) if FLAGS["enable_reme"] else InMemoryMemory()
+        await load_session(session_id=sess.session_id,memory=ctx.memory) # 只恢复短期记忆
+    return ctx
 
 async def agent_runner(sess: Session):
     while True:
@@ -125,6 +234,7 @@ async def agent_runner(sess: Session):
         if status==SessionStatus.INACTIVE:
             await SESS_MGR.delete_session(sess.session_id) # 内存中淘汰会话，下一个请求正常响应；已经持有session对象的请求add request会立即拒绝；
             await sess.release() # 释放MCP资源
+            await SESSION_STORE.close_session(sess.session_id) # 落盘并丢弃增量追踪状态
             break
 
         await sess.activate() 
@@ -136,79 +246,39 @@ async def agent_runner(sess: Session):
         try:
             session_id=request.session_id
             response_q=request.response_queue
-            toolkit=await build_agent_toolkit(sess)
+            ctx=await get_agent_context(sess)
 
-            extra_sys_prompt = [AGENT_PERSONA_PROMPT, CRON_PROMPT]
-            if FLAGS["enable_subagent"]:
-                toolkit.register_tool_function(await build_subagent_tool())
-                extra_sys_prompt.append(SUBAGENT_PROMPT)
-            if FLAGS["enable_reme"]:
-                extra_sys_prompt.append(REME_PROMPT)
-            extra_sys_prompt='\n'.join(extra_sys_prompt)
-            
             plan_notebook=None
+            for tool_name in ctx.plan_tools: # 清理上一次请求注册的planning工具，避免与本次重名
+                ctx.toolkit.remove_tool_function(tool_name)
             if request.deepresearch:
-                plan_notebook=PlanNotebook()
-                await load_session(session_id, plan_notebook=plan_notebook)# 只恢复planning
+                if ctx.plan_notebook is None:
+                    ctx.plan_notebook=PlanNotebook()
+                    await load_session(session_id, plan_notebook=ctx.plan_notebook)# 只恢复planning
+                plan_notebook=ctx.plan_notebook
 
             agent=OpenClaw(
                 name="Owen",
-                sys_prompt=format_system_prompt(extra_sys_prompt),
-                model=OpenAIChatModelCached(
-                    model_name="qwen3.6-plus",
-                    api_key=os.environ["DASHSCOPE_API_KEY"],
-                    stream=True,
-                    client_kwargs={
-                        'base_url': 'https://dashscope.aliyuncs.com/compatible-mode/v1',
-                    },
-                    generate_kwargs={
-                        'extra_body': {
-                            'enable_thinking': False,
-                            'enable_search': True,
-                            'search_options': {
-                                'enable_search_extension': True,
-                                'forced_search': True,
-                            },
-                        }
-                    }
-                ),
-                formatter=OpenAIChatFormatter(),
-                toolkit=toolkit,
+                sys_prompt=ctx.sys_prompt,
+                model=ctx.model,
+                formatter=ctx.formatter,
+                toolkit=ctx.toolkit,
                 plan_notebook=plan_notebook,
                 parallel_tool_calls=True,
-                memory=ReMeInMemoryMemory(hf_token_counter) if FLAGS["enable_reme"] else InMemoryMemory(),
+                memory=ctx.memory,
                 max_iters=sys.maxsize, # 使用系统最大整数，支持长程执行
                 sess=sess,
             )
-            
-            await load_session(session_id=session_id,memory=agent.memory) # 只恢复短期记忆
+            ctx.plan_tools=[tool.__name__ for tool in plan_notebook.list_tools()] if plan_notebook else []
 
             agent.set_console_output_enabled(False)
             if FLAGS["enable_reme"]:
                 await register_reme(agent)
             else:
-                agent.compression_config=ReActAgent.CompressionConfig(
-                    enable=True,
-                    agent_token_counter=VLTokenCounter(),
-                    trigger_threshold=60*1000,
-                    keep_recent=3,
-                    compression_model=OpenAIChatModel(
-                         # 百炼只有部分模型支持json schema: https://bailian.console.aliyun.com/cn-beijing/?spm=5176.29619931.J_PvCec88exbQTi-U433Fxg.4.74cd10d7jGKMNJ&tab=doc#/doc/?type=model&url=2862209
-                        model_name="qwen-plus",
-                        api_key=os.environ["DASHSCOPE_API_KEY"],
-                        stream=False,
-                        client_kwargs={
-                            'base_url': 'https://dashscope.aliyuncs.com/compatible-mode/v1',
-                        },
-                        generate_kwargs={
-                            'extra_body': {
-                                'enable_thinking': False,
-                            }
-                        }
-                    ),
-                )
+                agent.compression_config=ctx.compression_config
             await register_sess_keepalive(agent,sess)
             await register_memory_autosave(agent,sess)
+            await register_tool_image_externalize(agent)
             await register_reasoning_hint(agent)
             
             inputs = Msg(
@@ -217,28 +287,46 @@ async def agent_runner(sess: Session):
                 role="user",
             )
             q=asyncio.Queue()
+            plan_events=PlanEvents()
+            async def on_plan_change(notebook, plan):
+                event=plan_events.event(plan)
+                if event is not None:
+                    await q.put(event)
             async def streaming():
                 try:
                     if request.canceled:
                         return
+                    await q.put(plan_events.event(plan_notebook.current_plan if plan_notebook else None)) # 开始时同步一次当前plan
+                    if plan_notebook:
+                        plan_notebook.register_plan_change_hook('sse_plan', on_plan_change)
+                    delta_encoder=DeltaEncoder() if request.delta else None
                     async for msg,last in stream_printing_messages(agents=[agent],coroutine_task=agent(inputs)):
                         msg_id = msg.id if hasattr(msg, 'id') else None
-                        msg_ret={'msg_id': msg_id,'last': last,'contents':[],'plan':plan_notebook.current_plan.model_dump() if plan_notebook and plan_notebook.current_plan else None}
-                        for content in msg.content:
-                            if content['type']=='text':
-                                msg_ret['contents'].append({"type": "text", "content": content['text']})
-                            elif content['type']=='tool_use':
-                                msg_ret['contents'].append({"type": "tool_use", "tool_use_id": content["id"], "content": f'{content["name"]}: {json.dumps(content["input"], ensure_ascii=False)}'})
-                            elif content['type']=='tool_result':
-                                msg_ret['contents'].append({"type": "tool_result", "tool_use_id": content["id"], "content": f'{content["name"]}: {json.dumps(content["output"], ensure_ascii=False)}'})
+                        msg_ret={'msg_id': msg_id,'last': last,'contents':msg_to_contents(msg)}
+                        if delta_encoder and msg_id:
+                            if last: # 最后一个chunk下发完整内容，客户端据此校准
+                                delta_encoder.finish(msg_id)
+                            else:
+                                msg_ret['contents']=delta_encoder.encode(msg_id,msg_ret['contents'])
+                                if not msg_ret['contents']:
+                                    continue
+                                msg_ret['delta']=True
                         await q.put(msg_ret)
                     await save_session(session_id, memory=agent.memory, plan_notebook=agent.plan_notebook)
                 except asyncio.CancelledError as e:
-                    await q.put({'msg_id': None,'last': True,'contents':[],'plan':None, 'cancel':True})
+                    ctx.reset_states()
+                    await q.put({'msg_id': None,'last': True,'contents':[], 'cancel':True})
                 except Exception as e:
                     print(f"Error in agent_runner: {e} {traceback.format_exc()}")
-                    await q.put({'msg_id': None,'last': True,'contents':[],'plan':None, 'error':str(e)})
+                    ctx.reset_states()
+                    await q.put({'msg_id': None,'last': True,'contents':[], 'error':str(e)})
                 finally:
+                    ctx.formatter.hint = None # 下一次请求的压缩检查不能带上本次残留的时间hint
+                    if plan_notebook:
+                        try:
+                            plan_notebook.remove_plan_change_hook('sse_plan')
+                        except ValueError: # 请求在注册前就被取消
+                            pass
                     await q.put(None)
             request.stream_task = asyncio.create_task(streaming())
             while True:
@@ -257,12 +345,64 @@ async def create_agent_if_not_exists(session_id: str) -> Session:
     return sess
 
 #### services
-async def load_agent_states(session_id: str) -> AgentStates|None:
-    session=JSONSession(save_dir=".sessions")
+SUMMARY_MSG_ID = "compressed-summary"
+
+def _truncate(text: str, max_chars: int | None) -> tuple[str, bool]:
+    if max_chars is None or len(text) <= max_chars:
+        return text, False
+    return text[:max_chars], True
+
+def _history_block(block: dict, exclude_tools: bool, max_block_chars: int | None) -> dict | None:
+    if exclude_tools and block.get('type') in ('tool_use', 'tool_result'):
+        return None
+    if block.get('type') == 'text':
+        text, truncated = _truncate(block['text'], max_block_chars)
+        return {**block, 'text': text, 'truncated': True} if truncated else block
+    if block.get('type') == 'tool_result' and max_block_chars is not None:
+        output = block.get('output')
+        if isinstance(output, str):
+            output, truncated = _truncate(output, max_block_chars)
+            return {**block, 'output': output, 'truncated': True} if truncated else block
+        if isinstance(output, list):
+            return {**block, 'output': [_history_block(item, False, max_block_chars) if isinstance(item, dict) else item for item in output]}
+    return block
+
+def _history_msg(msg: dict, exclude_tools: bool, max_block_chars: int | None) -> dict | None:
+    content = msg.get('content')
+    if isinstance(content, str):
+        text, truncated = _truncate(content, max_block_chars)
+        return {**msg, 'content': text, 'truncated': True} if truncated else msg
+    blocks = [_history_block(block, exclude_tools, max_block_chars) for block in content or []]
+    blocks = [block for block in blocks if block is not None]
+    if not blocks and content: # 只有工具调用的消息整条跳过
+        return None
+    return {**msg, 'content': blocks}
+
+async def load_history(session_id: str, limit: int | None = None, cursor: str | None = None, exclude_tools: bool = False, max_block_chars: int | None = None) -> dict | None:
+    """直接读取会话存储里的消息字典（不构造Msg/InMemoryMemory），从最新往前分页
 
-    memory=InMemoryMemory()
-    try:
-        await session.load_session_state(session_id=session_id,allow_not_exist=False,memory=memory) 
-    except Exception as e:
+    cursor是上一页最早一条消息的id，返回该消息之前的limit条，页内按时间正序；
+    limit为空时返回全部。会话不存在返回None，cursor不存在时抛出KeyError。
+    """
+    states=await SESSION_STORE.load_states(session_id)
+    if states is None or 'memory' not in states:
         return None
-    return AgentStates(session_id=session_id, memory=memory)
\ No newline at end of file
+    memory=states['memory']
+    msgs=[msg for msg, marks in memory.get('content', []) if 'compressed' not in marks]
+    if memory.get('_compressed_summary'): # 与InMemoryMemory.get_memory一致，摘要作为最早的一条消息
+        msgs.insert(0, {'id': SUMMARY_MSG_ID, 'name': 'user', 'role': 'user', 'content': memory['_compressed_summary'], 'metadata': None, 'timestamp': None})
+    end=len(msgs)
+    if cursor is not None:
+        end=next((i for i, msg in enumerate(msgs) if msg.get('id') == cursor), None)
+        if end is None:
+            raise KeyError(cursor)
+    page=[]
+    idx=end-1
+    while idx >= 0 and (limit is None or len(page) < limit):
+        msg=_history_msg(msgs[idx], exclude_tools, max_block_chars)
+        if msg is not None:
+            page.append(msg)
+        idx-=1
+    page.reverse()
+    has_more=any(_history_msg(msgs[i], exclude_tools, None) is not None for i in range(idx, -1, -1)) # 剩下的消息可能全被exclude_tools过滤掉
+    return {'history': page, 'next_cursor': page[0]['id'] if has_more and page else None, 'has_more': has_more}
\ No newline at end of file
@@ -1,12 +1,14 @@
 import json
 import os
 import sys
+import time
 from datetime import datetime
-from typing import AsyncGenerator,List
+from typing import AsyncGenerator,Dict,List
+
+import frontmatter
 
 from agentscope.agent import ReActAgent
 from agentscope.formatter import OpenAIChatFormatter
-from agentscope.mcp import HttpStatelessClient
 from agentscope.memory import InMemoryMemory
 from agentscope.message import Msg, TextBlock
 from agentscope.model import OpenAIChatModel
@@ -20,8 +22,9 @@ from agentscope.tool import (
     view_text_file,
     write_text_file,
 )
-from model import OpenAIChatModelCached, VLTokenCounter
+from model import OpenAIChatModelCached, compression_token_counter, llm_client_kwargs
 from session import Session, SESS_MGR
+from mcp_pool import MCP_REGISTRY
 from conf import FLAGS
 if FLAGS["enable_reme"]:
     from reme.reme_light import ReMeLight
@@ -194,18 +197,151 @@ def modify_persona_file(filename: str, content: str) -> None:
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
     with open(filepath, "w", encoding="utf-8") as f:
         f.write(content)
+    PROMPT_CACHE.invalidate() # 立即生效，不等下一次mtime检查
+
+def _stat_version(path: str):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+PERSONA_FILES = ("AGENTS.md", "SOUL.md", "USER.md")
+
+class SystemPromptCache:
+    """人格文件内容和渲染后系统提示词的缓存
+
+    按(人格文件版本, extra_prompt)缓存渲染结果，同样的输入得到字节级一致的提示词，利于模型侧前缀缓存。
+    modify_persona_file会立即使缓存失效并改变版本号（同一mtime刻度内的等长修改也能感知）；
+    外部直接修改文件的情况按check_interval检查mtime+size。
+    """
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self.checked_at = 0.0
+        self.invalidations = 0
+        self.persona_ver: tuple | None = None
+        self.persona: Dict[str, str] = {}
+        self.rendered: Dict[tuple, str] = {}
+
+    def invalidate(self):
+        self.checked_at = 0.0
+        self.invalidations += 1
+        self.persona_ver = None
+        self.rendered = {}
+
+    def _refresh(self):
+        now = time.time()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        version = (self.invalidations, *(_stat_version(os.path.join(".agent/defines", filename)) for filename in PERSONA_FILES))
+        if version != self.persona_ver:
+            self.persona = {filename: load_persona_file(filename) for filename in PERSONA_FILES}
+            self.persona_ver = version
+            self.rendered = {}
+
+    def version(self) -> tuple:
+        self._refresh()
+        return self.persona_ver
+
+    def personas(self) -> Dict[str, str]:
+        """人格文件名 -> 内容，与version()同一次刷新的结果"""
+        self._refresh()
+        return self.persona
+
+    def render(self, extra_prompt: List[str]) -> str:
+        self._refresh()
+        key = tuple(extra_prompt)
+        prompt = self.rendered.get(key)
+        if prompt is None:
+            prompt = AGENT_SYS_PROMPT.format(
+                agents_md=self.persona["AGENTS.md"] or "(未定义)",
+                soul_md=self.persona["SOUL.md"] or "(未定义)",
+                user_md=self.persona["USER.md"] or "(未定义)",
+                extra_prompt="\n".join(extra_prompt)
+            )
+            self.rendered[key] = prompt
+        return prompt
+
+PROMPT_CACHE = SystemPromptCache()
+
+def persona_version():
+    """人格文件的版本标识(mtime+size)，文件被修改后变化"""
+    return PROMPT_CACHE.version()
+
+class SkillCatalog:
+    """skill元数据缓存：每个SKILL.md只解析一次，按mtime+size判断是否需要重新解析
+
+    扫描目录只需要listdir和stat，check_interval内的重复调用直接返回上一次的结果。
+    """
+    def __init__(self, skills_dir: str = ".agent/skills", check_interval: float = 1.0):
+        self.skills_dir = skills_dir
+        self.check_interval = check_interval
+        self.entries: Dict[str, tuple] = {}  # 子目录名 -> (SKILL.md版本, AgentSkill或None)
+        self.checked_at = 0.0
+        self.cached_version: tuple = ()
+        self.cached_skills: List[dict] = []
+
+    def _parse(self, skill_dir: str) -> dict | None:
+        # 与Toolkit.register_agent_skill的校验保持一致，不合规的skill跳过
+        try:
+            with open(os.path.join(skill_dir, "SKILL.md"), "r", encoding="utf-8") as f:
+                post = frontmatter.load(f)
+        except Exception:
+            return None
+        name, description = post.get("name", None), post.get("description", None)
+        if not name or not description:
+            return None
+        return {"name": str(name), "description": str(description), "dir": skill_dir}
+
+    def _refresh(self):
+        now = time.time()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        entries = {}
+        for name in sorted(os.listdir(self.skills_dir)):
+            skill_dir = os.path.join(self.skills_dir, name)
+            if not os.path.isdir(skill_dir):
+                continue
+            version = _stat_version(os.path.join(skill_dir, "SKILL.md"))
+            cached = self.entries.get(name)
+            if cached is not None and cached[0] == version:
+                entries[name] = cached
+            else:
+                entries[name] = (version, self._parse(skill_dir) if version is not None else None)
+        self.entries = entries
+        self.cached_version = tuple((name, version) for name, (version, _) in entries.items())
+        skills, seen = [], set()
+        for _, skill in entries.values():
+            if skill is not None and skill["name"] not in seen: # 重名skill只保留第一个
+                seen.add(skill["name"])
+                skills.append(skill)
+        self.cached_skills = skills
+
+    def version(self) -> tuple:
+        self._refresh()
+        return self.cached_version
+
+    def skills(self) -> List[dict]:
+        self._refresh()
+        return self.cached_skills
+
+    def register(self, toolkit: Toolkit):
+        """把缓存的skill注册到toolkit，等价于对每个目录调用register_agent_skill"""
+        for skill in self.skills():
+            if skill["name"] not in toolkit.skills:
+                toolkit.skills[skill["name"]] = dict(skill)
+
+SKILL_CATALOG = SkillCatalog()
+
+def skills_version():
+    """skills目录的版本标识，安装/删除skill或修改SKILL.md后变化"""
+    return SKILL_CATALOG.version()
 
 def format_system_prompt(extra_prompt: List[str]) -> str:
     """生成系统提示词，注入人格定义文件内容"""
-    agents_md = load_persona_file("AGENTS.md")
-    soul_md = load_persona_file("SOUL.md")
-    user_md = load_persona_file("USER.md")
-    return AGENT_SYS_PROMPT.format(
-        agents_md=agents_md or "(未定义)",
-        soul_md=soul_md or "(未定义)",
-        user_md=user_md or "(未定义)",
-        extra_prompt="\n".join(extra_prompt)
-    )
+    return PROMPT_CACHE.render(extra_prompt)
 
 reme=None
 hf_token_counter: HuggingFaceTokenCounter=None
@@ -245,9 +381,7 @@ async def web_search(query: str) -> AsyncGenerator[ToolResponse, None]:
         model_name="qwen3-max",
         api_key=os.environ["DASHSCOPE_API_KEY"],
         stream=True,
-        client_kwargs={
-            'base_url': 'https://dashscope.aliyuncs.com/compatible-mode/v1',
-        },
+        client_kwargs=llm_client_kwargs(),
         generate_kwargs={
             'extra_body': {
                 'enable_thinking': False,
@@ -289,9 +423,7 @@ async def build_subagent_tool():
                     model_name="qwen3.6-plus",
                     api_key=os.environ["DASHSCOPE_API_KEY"],
                     stream=True,
-                    client_kwargs={
-                        'base_url': 'https://dashscope.aliyuncs.com/compatible-mode/v1',
-                    },
+                    client_kwargs=llm_client_kwargs(),
                     generate_kwargs={
                         'extra_body': {
                             'enable_thinking': False,
@@ -309,16 +441,14 @@ async def build_subagent_tool():
                 memory=InMemoryMemory(),
                 compression_config=ReActAgent.CompressionConfig(
                     enable=True,
-                    agent_token_counter=VLTokenCounter(),
+                    agent_token_counter=compression_token_counter(),
                     trigger_threshold=60*1000,
                     keep_recent=3,
                     compression_model=OpenAIChatModel(
                         model_name="qwen3.6-plus",
                         api_key=os.environ["DASHSCOPE_API_KEY"],
                         stream=False,
-                        client_kwargs={
-                            'base_url': 'https://dashscope.aliyuncs.com/compatible-mode/v1',
-                        }
+                        client_kwargs=llm_client_kwargs()
                     ),
                 ),
                 max_iters=sys.maxsize,  # 使用系统最大整数，支持长程执行
@@ -372,6 +502,24 @@ async def build_subagent_tool():
     subagent_tool.__doc__ = docstr
     return subagent_tool
 
+def stateful_mcp_configs() -> dict:
+    """已启用的有状态MCP连接参数（name -> kwargs），会话注册和启动预热共用"""
+    configs = {}
+    if FLAGS["enable_agentrun_browser_mcp"]:
+        configs["Browser-MCP"] = dict(
+            type="http",
+            transport="streamable_http",
+            url="https://1267341675397299.agentrun-data.cn-hangzhou.aliyuncs.com/templates/sandbox-browser-p918At/mcp",
+            headers={"X-API-Key": f"Bearer {os.environ.get('AGENTRUN_BROWSER_API_KEY', '')}"}
+        )
+    if FLAGS["enable_playwright_mcp"]:
+        configs["Playwright-MCP"] = dict(
+            type="stdio",
+            command="npx",
+            args=["@playwright/mcp@latest"]
+        )
+    return configs
+
 async def build_agent_toolkit(sess: Session):
     toolkit = Toolkit(
         agent_skill_instruction=f'''# Skills 使用指南
@@ -402,12 +550,7 @@ async def build_agent_toolkit(sess: Session):
         ''',
         agent_skill_template="- name: {name}  dir: {dir}  desc: {description}")
     # skills
-    for skill_dir in os.listdir(".agent/skills"):
-        if os.path.isdir(os.path.join(".agent/skills", skill_dir)):
-            try:
-                toolkit.register_agent_skill(os.path.join(".agent/skills", skill_dir))
-            except BaseException as e:
-                pass
+    SKILL_CATALOG.register(toolkit)
     # Tools
     if FLAGS["enable_view_text_file"]:
         toolkit.register_tool_function(view_text_file)
@@ -418,29 +561,17 @@ async def build_agent_toolkit(sess: Session):
     if FLAGS["enable_execute_shell_command"]:
         toolkit.register_tool_function(execute_shell_command)
     # Stateful MCP
-    if FLAGS["enable_agentrun_browser_mcp"]:
-        await sess.register_stateful_mcp(
-            toolkit,
-            type="http",
-            name="Browser-MCP",
-            transport="streamable_http",
-            url="https://1267341675397299.agentrun-data.cn-hangzhou.aliyuncs.com/templates/sandbox-browser-p918At/mcp",
-            headers={"X-API-Key": f"Bearer {os.environ.get('AGENTRUN_BROWSER_API_KEY', '')}"}
-        )
+    configs = stateful_mcp_configs()
+    if "Browser-MCP" in configs:
+        await sess.register_stateful_mcp(toolkit, name="Browser-MCP", **configs["Browser-MCP"])
     if FLAGS["enable_sandbox"]:
         await sess.register_sandbox(toolkit)
-    if FLAGS["enable_playwright_mcp"]:
-        await sess.register_stateful_mcp(
-            toolkit,
-            type="stdio",
-            name="Playwright-MCP",
-            command="npx",
-            args=["@playwright/mcp@latest"]
-        )
+    if "Playwright-MCP" in configs:
+        await sess.register_stateful_mcp(toolkit, name="Playwright-MCP", **configs["Playwright-MCP"])
     # Stateless MCP
     if FLAGS["enable_bazi_mcp"]:
-        await toolkit.register_mcp_client(
-            HttpStatelessClient("Bazi-MCP", "sse", "https://mcp.api-inference.modelscope.net/cf651826916d46/sse")
+        await toolkit.register_mcp_client( # 进程内共享client，tool列表走缓存
+            MCP_REGISTRY.get("Bazi-MCP", "sse", "https://mcp.api-inference.modelscope.net/cf651826916d46/sse")
         )
     if FLAGS["enable_websearch"]:
         toolkit.register_tool_function(web_search)